@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import metrics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Файл базы с историей задач; пустой ANALYSIS_DB отключает историю
+ANALYSIS_DB = os.getenv('ANALYSIS_DB', os.path.join(BASE_DIR, 'analyses.db'))
+
+# Записи копятся в очереди и пишутся одной транзакцией: до STORE_BATCH_SIZE строк или раз в STORE_FLUSH_INTERVAL секунд
+STORE_BATCH_SIZE = int(os.getenv('STORE_BATCH_SIZE', '200'))
+STORE_FLUSH_INTERVAL = float(os.getenv('STORE_FLUSH_INTERVAL', '0.5'))
+
+# Ограничение размера страницы в запросах истории
+MAX_PAGE_SIZE = 100
+
+STORE_WRITES = metrics.REGISTRY.counter(
+    'revert_store_rows_written_total', 'Job rows written to the analysis store')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    tx_hash TEXT,
+    contract TEXT,
+    selector TEXT,
+    revert_type TEXT,
+    revert_reason TEXT,
+    fingerprint TEXT,
+    model TEXT,
+    prompt_version INTEGER,
+    created_at REAL NOT NULL,
+    duration REAL,
+    revert TEXT,
+    timings TEXT,
+    analysis TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_tx_hash ON jobs (tx_hash, id);
+CREATE INDEX IF NOT EXISTS jobs_contract ON jobs (contract, id);
+CREATE INDEX IF NOT EXISTS jobs_selector ON jobs (selector, id);
+CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint);
+
+-- Счётчики ревертов реальных транзакций по контрактам за день, чтобы топ не требовал GROUP BY по всей истории
+CREATE TABLE IF NOT EXISTS contract_daily (
+    day INTEGER NOT NULL,
+    contract TEXT NOT NULL,
+    reverts INTEGER NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (day, contract)
+) WITHOUT ROWID;
+"""
+
+JOB_COLUMNS = (
+    'kind', 'status', 'tx_hash', 'contract', 'selector', 'revert_type', 'revert_reason',
+    'fingerprint', 'model', 'prompt_version', 'created_at', 'duration', 'revert', 'timings', 'analysis'
+)
+
+# Колонки истории без текста анализа, он отдаётся только по запросу
+HISTORY_COLUMNS = (
+    'id', 'kind', 'status', 'tx_hash', 'contract', 'selector', 'revert_type', 'revert_reason',
+    'fingerprint', 'model', 'created_at', 'duration'
+)
+
+# Фильтры истории: параметр запроса -> колонка
+HISTORY_FILTERS = {
+    'txHash': 'tx_hash',
+    'contract': 'contract',
+    'selector': 'selector',
+    'kind': 'kind',
+    'status': 'status',
+    'fingerprint': 'fingerprint',
+}
+
+def get_call_info(trace):
+    """Адрес контракта и селектор первого вызова в трейсе"""
+    for op in trace or []:
+        if op['op'] == 'CALL':
+            input_data = op['args'].get('input_data') or '0x'
+            return (op['args'].get('to') or '').lower() or None, input_data[:10]
+    return None, None
+
+def make_job(kind, status, tx_hash=None, contract=None, selector=None, revert=None, fingerprint=None,
+             model=None, prompt_version=None, duration=None, timings=None, analysis=None):
+    """Строка истории для add"""
+    revert = revert or {}
+    return {
+        'kind': kind,
+        'status': status,
+        'tx_hash': tx_hash.lower() if tx_hash else None,
+        'contract': contract.lower() if contract else None,
+        'selector': selector.lower() if selector else None,
+        'revert_type': revert.get('type'),
+        'revert_reason': revert.get('reason'),
+        'fingerprint': (fingerprint or {}).get('fingerprint'),
+        'model': model,
+        'prompt_version': prompt_version,
+        'created_at': time.time(),
+        'duration': duration,
+        'revert': json.dumps(revert) if revert else None,
+        'timings': json.dumps(timings) if timings else None,
+        'analysis': analysis,
+    }
+
+class AnalysisStore:
+    """
+    История задач в SQLite. add ставит строку в очередь, фоновый поток пишет очередь пачками.
+    Запросы читают через отдельное соединение каждого потока.
+    """
+    def __init__(self, path=ANALYSIS_DB, batch_size=STORE_BATCH_SIZE, flush_interval=STORE_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue()
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+        self.writer = threading.Thread(target=self.write_loop, name='analysis-store', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, job):
+        self.pending.put(job)
+
+    def write_loop(self):
+        conn = self.connect()
+        while True:
+            job = self.pending.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+            try:
+                self.write_batch(conn, batch)
+            except sqlite3.Error as e:
+                print(f"Error writing {len(batch)} jobs to the analysis store: {e}")
+            if stop:
+                break
+        conn.close()
+
+    def write_batch(self, conn, batch):
+        with conn:
+            conn.executemany(
+                f"INSERT INTO jobs ({', '.join(JOB_COLUMNS)}) VALUES ({', '.join('?' * len(JOB_COLUMNS))})",
+                [tuple(job.get(column) for column in JOB_COLUMNS) for job in batch]
+            )
+            conn.executemany(
+                """INSERT INTO contract_daily (day, contract, reverts, last_seen) VALUES (?, ?, 1, ?)
+                   ON CONFLICT (day, contract) DO UPDATE SET
+                       reverts = reverts + 1, last_seen = max(last_seen, excluded.last_seen)""",
+                [
+                    (int(job['created_at'] // 86400), job['contract'], job['created_at'])
+                    for job in batch if job.get('tx_hash') and job.get('contract') and job.get('revert_type')
+                ]
+            )
+        STORE_WRITES.inc(len(batch))
+
+    def close(self):
+        """Дописывает очередь и останавливает поток записи"""
+        if self.writer.is_alive():
+            self.pending.put(None)
+            self.writer.join(timeout=10)
+
+    def history(self, filters=None, limit=20, cursor=None, since=None, until=None, include_analysis=False):
+        """
+        Страница истории от новых к старым. cursor - id последней строки предыдущей страницы.
+        Возвращает (строки, cursor следующей страницы или None).
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        where, params = [], []
+        for key, column in HISTORY_FILTERS.items():
+            value = (filters or {}).get(key)
+            if value:
+                value = str(value)
+                where.append(f"{column} = ?")
+                params.append(value.lower() if column in ('tx_hash', 'contract', 'selector') else value)
+        if cursor is not None:
+            where.append("id < ?")
+            params.append(int(cursor))
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(float(since))
+        if until is not None:
+            where.append("created_at < ?")
+            params.append(float(until))
+        columns = HISTORY_COLUMNS + (('analysis', 'revert', 'timings') if include_analysis else ())
+        sql = f"SELECT {', '.join(columns)} FROM jobs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # Берём на одну строку больше, чтобы знать, есть ли следующая страница
+        sql += " ORDER BY id DESC LIMIT ?"
+        rows = self.reader().execute(sql, params + [limit + 1]).fetchall()
+        items = []
+        for row in rows[:limit]:
+            item = dict(row)
+            for column in ('revert', 'timings'):
+                if item.get(column):
+                    item[column] = json.loads(item[column])
+            items.append(item)
+        next_cursor = items[-1]['id'] if len(rows) > limit else None
+        return items, next_cursor
+
+    def top_reverting(self, since=None, limit=20, offset=0):
+        """Контракты с наибольшим числом ревертов с момента since (по умолчанию за всё время)"""
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        day = int(float(since) // 86400) if since is not None else 0
+        rows = self.reader().execute(
+            """SELECT contract, SUM(reverts) AS reverts, MAX(last_seen) AS last_seen
+               FROM contract_daily WHERE day >= ?
+               GROUP BY contract ORDER BY reverts DESC, contract LIMIT ? OFFSET ?""",
+            (day, limit, max(0, int(offset)))
+        ).fetchall()
+        return [dict(row) for row in rows]
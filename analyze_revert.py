@@ -6,6 +6,17 @@ import requests
 import time
 import traceback
 import sys
+from recorder import record
+import metrics
+from source_map import VERIFY_URL
+from revert_decoder import get_revert_data
+from llm_scheduler import SCHEDULER
+from model_router import TIERS, route, log_outcome
+from chunked_analysis import CHUNKED_ANALYSIS_TOKENS, analyze_chunked
+from fingerprint import (
+    FINGERPRINT_CACHE, FingerprintIndex, compute_fingerprint, get_code_hash,
+    get_revert_address, annotate_analysis
+)
 
 # Load environment variables
 load_dotenv()
@@ -13,6 +24,52 @@ load_dotenv()
 # Configure API key from environment variable
 genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
 
+MODEL_NAME = 'gemini-1.5-flash'
+
+# Меняется при любом изменении промпта, чтобы не отдавать из кэша анализы старой версии
+PROMPT_VERSION = 2
+
+# Сколько последних шагов трейса попадает в короткий промпт
+BRIEF_TRACE_STEPS = 60
+
+# Префикс текста анализа, который analyze_with_ai возвращает при ошибке
+ANALYSIS_ERROR_PREFIX = 'Error analyzing revert:'
+
+# Если задан LLM_URL, запросы к модели уходят на локальный replay-сервер вместо Gemini
+LLM_URL = os.getenv('LLM_URL')
+
+# run.py передаёт срок задачи (time.time()), чтобы в него входило и ожидание в очереди
+LLM_DEADLINE_AT = float(os.getenv('LLM_DEADLINE_AT')) if os.getenv('LLM_DEADLINE_AT') else None
+
+# Модели создаются один раз на процесс и переиспользуются всеми запросами
+MODELS = {}
+
+class ReplayResponse:
+    """Ответ replay-сервера с тем же интерфейсом, что и у Gemini"""
+    def __init__(self, text):
+        self.text = text
+
+class ReplayModel:
+    """Модель, которая отправляет промпт на replay-сервер"""
+    def __init__(self, model_name, url=LLM_URL):
+        self.model_name = model_name
+        self.url = url
+
+    def generate_content(self, prompt, request_options=None):
+        response = requests.post(
+            self.url,
+            json={'model': self.model_name, 'prompt': prompt},
+            timeout=(request_options or {}).get('timeout', 300)
+        )
+        response.raise_for_status()
+        return ReplayResponse(response.json()['text'])
+
+def get_model(model_name):
+    """Возвращает общую модель Gemini или её replay-замену"""
+    if model_name not in MODELS:
+        MODELS[model_name] = ReplayModel(model_name) if LLM_URL else genai.GenerativeModel(model_name)
+    return MODELS[model_name]
+
 def update_trace_with_source_map(trace, source_map):
     """Обновляет trace данными из source_map по pc"""
     # Only update operations around the revert
@@ -34,15 +91,18 @@ def update_trace_with_source_map(trace, source_map):
                 op['context_code'] = source_map[pc]['context_code']
     return trace
 
-def get_revert_info():
+def get_revert_info(trace_data=None):
     """
-    Получает информацию о реверте из cleaned_trace.json
+    Получает информацию о реверте из трейса или из cleaned_trace.json
     """
     try:
-        print("Reading cleaned_trace.json...")
-        sys.stdout.flush()
-        with open('cleaned_trace.json', 'r') as f:
-            trace_data = json.load(f)
+        if trace_data is None:
+            print("Reading cleaned_trace.json...")
+            sys.stdout.flush()
+            with metrics.span('json.read') as span:
+                with open('cleaned_trace.json', 'r') as f:
+                    trace_data = json.load(f)
+                    span['bytes_in'] = f.tell()
         print(f"Loaded {len(trace_data)} operations from trace")
         sys.stdout.flush()
             
@@ -100,15 +160,18 @@ def get_contract_info(contract_address):
         print(f"Fetching contract info for {contract_address}...")
         sys.stdout.flush()
         
-        response = requests.post(
-            'http://205.196.81.76:5000/verify',
-            headers={'Content-Type': 'application/json'},
-            json={'address': contract_address},
-            timeout=10
-        )
+        with metrics.span('http.verify') as span:
+            response = requests.post(
+                VERIFY_URL,
+                headers={'Content-Type': 'application/json'},
+                json={'address': contract_address},
+                timeout=10
+            )
+            span['bytes_in'] = len(response.content)
         
         if response.status_code == 200:
             data = response.json()
+            record('verify', {'address': contract_address}, data)
             print("Successfully fetched contract info")
             sys.stdout.flush()
             return data
@@ -124,22 +187,47 @@ def get_contract_info(contract_address):
         sys.stdout.flush()
         return {'source': ''}
 
-def analyze_with_ai(tx_hash, contract_address, function_signature, revert_info, contract_info):
+def prompt_header(tx_hash, contract_address, function_signature):
+    return f"""You are an AI assistant specialized in analyzing Ethereum transaction traces and debugging smart contract issues. Your task is to analyze the transaction trace and provide insights about what went wrong. The result will be shown to the user in a web interface.
+
+Transaction Hash: {tx_hash}
+Contract Address: {contract_address}
+Function Signature: {function_signature}"""
+
+def build_prompt(variant, tx_hash, contract_address, function_signature, trace, source_code):
     """
-    Анализирует реверт с помощью AI
+    Формирует промпт. full - подробный анализ всего трейса,
+    brief - короткий анализ простого реверта по последним шагам трейса.
     """
-    try:
-        # Подготавливаем данные
-        source_code = contract_info.get('sources', '')
-        cleaned_trace = json.dumps(revert_info['trace'], indent=2)
-        
-        # Формируем промпт
-        prompt = f"""You are an AI assistant specialized in analyzing Ethereum transaction traces and debugging smart contract issues. Your task is to analyze the transaction trace and provide insights about what went wrong. The result will be shown to the user in a web interface.
+    if variant == 'brief':
+        # Для простого реверта достаточно вызова и шагов перед REVERT
+        if len(trace) > BRIEF_TRACE_STEPS + 1:
+            trace = trace[:1] + trace[-BRIEF_TRACE_STEPS:]
+        cleaned_trace = json.dumps(trace, indent=2)
+        return f"""You are an AI assistant that explains failed Ethereum transactions. The revert below is a simple one: explain it briefly. The result will be shown to the user in a web interface.
 
 Transaction Hash: {tx_hash}
 Contract Address: {contract_address}
 Function Signature: {function_signature}
 
+Source Code Context:
+```solidity
+{source_code}
+```
+
+Don't ask questions and don't ask user to provide more information, just provide the analysis.
+Keep each section to a few sentences and use this format:
+1. Summary of the issue
+2. Detailed analysis of the trace
+3. Root cause
+4. Recommendations
+
+Trace Data (the first call and the last steps before the REVERT):
+{cleaned_trace}"""
+
+    cleaned_trace = json.dumps(trace, indent=2)
+    return f"""{prompt_header(tx_hash, contract_address, function_signature)}
+
 The trace data is provided in cleaned_trace.json and contains the following information:
 1. Operation codes (opcodes) executed during the transaction
 2. Arguments for each operation
@@ -172,22 +260,145 @@ Focus on being precise and technical, but also explain concepts in a way that's
 Trace Data:
 {cleaned_trace}"""
 
-        # Сохраняем промпт в файл
-        with open('prompt.txt', 'w') as f:
-            f.write(prompt)
+def generate(model_name, prompt, deadline=None):
+    """Отправляет промпт модели через общую очередь запросов и возвращает текст ответа"""
+    model = get_model(model_name)
+    with metrics.span('llm.generate_content') as span:
+        span['bytes_out'] = len(prompt.encode())
+        response = SCHEDULER.generate(model, prompt, deadline or LLM_DEADLINE_AT)
+        span['bytes_in'] = len(response.text.encode())
+    record('llm', {'model': model_name, 'prompt': prompt}, {'text': response.text})
+    return response.text
+
+def analyze_with_ai(tx_hash, contract_address, function_signature, revert_info, contract_info, prompt_path='prompt.txt', deadline=None):
+    """
+    Анализирует реверт с помощью AI. Модель и вариант промпта выбирает model_router,
+    слишком большой трейс анализируется по частям.
+    """
+    try:
+        # Подготавливаем данные
+        source_code = contract_info.get('sources', '')
+        decision = route(revert_info, contract_info)
+        print(f"Routing to {decision['tier']} tier ({decision['model']}, score {decision['score']})")
+        sys.stdout.flush()
+        started = time.perf_counter()
         
-        # Generate response with Gemini
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
+        if decision['features']['traceTokens'] >= CHUNKED_ANALYSIS_TOKENS:
+            # Части суммирует стандартная модель, итоговый отчёт - выбранная роутером
+            try:
+                analysis, decision['chunks'], prompts = analyze_chunked(
+                    revert_info['trace'],
+                    prompt_header(tx_hash, contract_address, function_signature),
+                    source_code,
+                    lambda prompt: generate(TIERS['standard']['model'], prompt, deadline),
+                    lambda prompt: generate(decision['model'], prompt, deadline)
+                )
+            except Exception as e:
+                log_outcome(decision, tx_hash, time.perf_counter() - started, '', error=str(e))
+                raise
+            log_outcome(decision, tx_hash, time.perf_counter() - started, ''.join(prompts), analysis)
+            
+            # Сохраняем итоговый промпт в файл
+            if prompt_path:
+                with open(prompt_path, 'w') as f:
+                    f.write(prompts[-1])
+        else:
+            # Формируем промпт
+            prompt = build_prompt(
+                decision['prompt'], tx_hash, contract_address, function_signature, revert_info['trace'], source_code
+            )
+            
+            # Сохраняем промпт в файл
+            if prompt_path:
+                with open(prompt_path, 'w') as f:
+                    f.write(prompt)
+            
+            try:
+                analysis = generate(decision['model'], prompt, deadline)
+            except Exception as e:
+                log_outcome(decision, tx_hash, time.perf_counter() - started, prompt, error=str(e))
+                raise
+            log_outcome(decision, tx_hash, time.perf_counter() - started, prompt, analysis)
         
-        return response.text
+        return analysis
         
     except Exception as e:
         print(f"Error in AI analysis: {e}")
         traceback.print_exc()
-        return f"Error analyzing revert: {str(e)}"
+        return f"{ANALYSIS_ERROR_PREFIX} {str(e)}"
+
+def run_analysis(tx_hash, revert_info, prompt_path='prompt.txt'):
+    """
+    Анализирует реверт: переиспользует анализ с тем же отпечатком или вызывает AI.
+    Возвращает (анализ, сведения об отпечатке).
+    """
+    # Считаем отпечаток реверта, чтобы переиспользовать анализ такой же ошибки
+    fingerprint_id = None
+    components = None
+    cached_entry = None
+    index = None
+    if FINGERPRINT_CACHE:
+        print("\nComputing revert fingerprint...")
+        sys.stdout.flush()
+        revert = get_revert_data(revert_info['trace'])
+        code_hash = get_code_hash(get_revert_address(revert_info['trace']))
+        # Без хэша кода отпечаток не отличает разные контракты, поэтому не используем его
+        if code_hash:
+            fingerprint_id, components = compute_fingerprint(
+                revert_info['trace'], revert, code_hash, MODEL_NAME, PROMPT_VERSION
+            )
+            index = FingerprintIndex()
+            cached_entry = index.get(fingerprint_id)
+            print(f"Fingerprint: {fingerprint_id} ({'hit' if cached_entry else 'miss'})")
+            sys.stdout.flush()
+        
+    # Получаем информацию о контракте
+    print("\nGetting contract info...")
+    sys.stdout.flush()
+    contract_address = revert_info['call']['args']['to']
+    print(f"Contract address: {contract_address}")
+    sys.stdout.flush()
+    
+    # Получаем сигнатуру функции из input_data
+    print("\nGetting function signature...")
+    sys.stdout.flush()
+    input_data = revert_info['call']['args']['input_data']
+    function_signature = input_data[:10] if input_data else "0x"
+    print(f"Function signature: {function_signature}")
+    sys.stdout.flush()
+    
+    if cached_entry:
+        print("\nReusing analysis of a matching revert...")
+        sys.stdout.flush()
+        analysis = annotate_analysis(cached_entry, tx_hash, revert_info['call'])
+    else:
+        contract_info = get_contract_info(contract_address)
+        
+        # Анализируем с помощью AI
+        print("\nStarting AI analysis...")
+        sys.stdout.flush()
+        analysis = analyze_with_ai(tx_hash, contract_address, function_signature, revert_info, contract_info, prompt_path)
+        if not analysis:
+            print("Error: AI analysis failed")
+            sys.stdout.flush()
+            return None, None
+        
+        if index and not analysis.startswith(ANALYSIS_ERROR_PREFIX):
+            index.put(fingerprint_id, {
+                'fingerprint': fingerprint_id,
+                'txHash': tx_hash,
+                'components': components,
+                'analysis': analysis
+            })
+    
+    return analysis, {
+        'fingerprint': fingerprint_id,
+        'hit': bool(cached_entry),
+        'sourceTx': cached_entry.get('txHash') if cached_entry else None
+    }
 
 def main():
+    metrics.report_startup()
     try:
         print("\n=== Starting Analysis ===")
         sys.stdout.flush()
@@ -221,31 +432,14 @@ def main():
             sys.stdout.flush()
             sys.exit(1)
             
-        # Получаем информацию о контракте
-        print("\nGetting contract info...")
-        sys.stdout.flush()
-        contract_address = revert_info['call']['args']['to']
-        print(f"Contract address: {contract_address}")
-        sys.stdout.flush()
-        contract_info = get_contract_info(contract_address)
-        
-        # Получаем сигнатуру функции из input_data
-        print("\nGetting function signature...")
-        sys.stdout.flush()
-        input_data = revert_info['call']['args']['input_data']
-        function_signature = input_data[:10] if input_data else "0x"
-        print(f"Function signature: {function_signature}")
-        sys.stdout.flush()
-        
-        # Анализируем с помощью AI
-        print("\nStarting AI analysis...")
-        sys.stdout.flush()
-        analysis = analyze_with_ai(tx_hash, contract_address, function_signature, revert_info, contract_info)
+        analysis, fingerprint_info = run_analysis(tx_hash, revert_info)
         if not analysis:
-            print("Error: AI analysis failed")
-            sys.stdout.flush()
             sys.exit(1)
             
+        # Сохраняем сведения об отпечатке для run.py
+        with open('fingerprint.json', 'w') as f:
+            json.dump(fingerprint_info, f)
+            
         # Сохраняем результат
         print("\nSaving analysis result...")
         sys.stdout.flush()
@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from rate_limit import TokenBucket
+from process_traces import rpc_batch, process_trace, hex_to_int
+from clean_trace import clean_trace_to_first_revert
+from source_map import apply_source_map
+from revert_decoder import get_revert_data
+from analyze_revert import get_revert_info, run_analysis
+from analysis_store import get_call_info
+
+# Сколько запросов отправлять в одном batch JSON-RPC
+RECEIPT_BATCH_SIZE = int(os.getenv('RECEIPT_BATCH_SIZE', '50'))
+
+# Ограничение на размер диапазона блоков в одном запросе
+MAX_SCAN_BLOCKS = int(os.getenv('MAX_SCAN_BLOCKS', '100'))
+
+SCANNED_TXS = metrics.REGISTRY.counter(
+    'revert_scanner_transactions_total', 'Failed transactions processed by the block scanner', ['status'])
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def get_block_receipts(block_numbers):
+    """
+    Получает receipts всех транзакций блоков batch-запросами.
+    Сначала пробует eth_getBlockReceipts, для блоков без ответа - receipts по одной транзакции.
+    """
+    receipts = []
+    missing = []
+    for chunk in chunks(block_numbers, RECEIPT_BATCH_SIZE):
+        results = rpc_batch([('eth_getBlockReceipts', [hex(number)]) for number in chunk])
+        for number, block_receipts in zip(chunk, results):
+            if block_receipts is None:
+                missing.append(number)
+            else:
+                receipts.extend(block_receipts)
+
+    if not missing:
+        return receipts
+
+    # Нода не поддерживает eth_getBlockReceipts: берём хэши транзакций и receipts по отдельности
+    tx_hashes = []
+    for chunk in chunks(missing, RECEIPT_BATCH_SIZE):
+        for block in rpc_batch([('eth_getBlockByNumber', [hex(number), False]) for number in chunk]):
+            if block:
+                tx_hashes.extend(block.get('transactions', []))
+    for chunk in chunks(tx_hashes, RECEIPT_BATCH_SIZE):
+        receipts.extend(r for r in rpc_batch([('eth_getTransactionReceipt', [h]) for h in chunk]) if r)
+    return receipts
+
+def find_failed_transactions(from_block, to_block):
+    """Возвращает неуспешные транзакции (status 0x0) в диапазоне блоков"""
+    receipts = get_block_receipts(list(range(from_block, to_block + 1)))
+    failed = []
+    for receipt in receipts:
+        if receipt.get('status') == '0x0':
+            failed.append({
+                'txHash': receipt['transactionHash'],
+                'blockNumber': hex_to_int(receipt.get('blockNumber')),
+                'to': receipt.get('to'),
+                'gasUsed': hex_to_int(receipt.get('gasUsed')),
+            })
+    return failed
+
+def process_failed_transaction(tx_hash, analyze=True):
+    """Трейс, очистка и (по желанию) анализ одной транзакции без записи файлов"""
+    trace = process_trace(tx_hash, output_path=None)
+    if not trace:
+        return {'txHash': tx_hash, 'status': 'trace_failed'}
+
+    cleaned = clean_trace_to_first_revert(trace)
+    if not cleaned:
+        # Например, out of gas: транзакция упала без REVERT
+        return {'txHash': tx_hash, 'status': 'no_revert', 'steps': len(trace)}
+
+    try:
+        apply_source_map(cleaned)
+    except Exception as e:
+        print(f"Error collecting source map for {tx_hash}: {e}")
+
+    contract, selector = get_call_info(cleaned)
+    result = {
+        'txHash': tx_hash,
+        'status': 'ok',
+        'contract': contract,
+        'selector': selector,
+        'revert': get_revert_data(cleaned)
+    }
+    if analyze:
+        revert_info = get_revert_info(cleaned)
+        if revert_info:
+            analysis, fingerprint_info = run_analysis(tx_hash, revert_info, prompt_path=None)
+            result['analysis'] = analysis
+            result['fingerprint'] = fingerprint_info
+    return result
+
+async def scan_blocks(from_block, to_block, emit, concurrency=4, rate=None, analyze=True):
+    """
+    Находит неуспешные транзакции в диапазоне блоков и обрабатывает их параллельно.
+    concurrency ограничивает число одновременных транзакций, rate - число новых транзакций в секунду.
+    emit - корутина, получающая события прогресса и результаты.
+    """
+    if to_block < from_block:
+        raise ValueError('toBlock must not be less than fromBlock')
+    if to_block - from_block + 1 > MAX_SCAN_BLOCKS:
+        raise ValueError(f'Block range is limited to {MAX_SCAN_BLOCKS} blocks')
+
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='scanner')
+    limiter = TokenBucket(rate) if rate else None
+    try:
+        failed = await loop.run_in_executor(executor, find_failed_transactions, from_block, to_block)
+        await emit({
+            'type': 'scan_progress',
+            'fromBlock': from_block,
+            'toBlock': to_block,
+            'found': len(failed),
+            'done': 0
+        })
+
+        semaphore = asyncio.Semaphore(concurrency)
+        results = []
+
+        async def worker(tx):
+            async with semaphore:
+                if limiter:
+                    await limiter.acquire_async()
+                try:
+                    result = await loop.run_in_executor(executor, process_failed_transaction, tx['txHash'], analyze)
+                except Exception as e:
+                    traceback.print_exc()
+                    result = {'txHash': tx['txHash'], 'status': 'error', 'message': str(e)}
+            result['blockNumber'] = tx['blockNumber']
+            SCANNED_TXS.inc(status=result['status'])
+            results.append(result)
+            await emit({'type': 'scan_result', 'result': result})
+            await emit({'type': 'scan_progress', 'found': len(failed), 'done': len(results)})
+
+        await asyncio.gather(*[worker(tx) for tx in failed])
+    finally:
+        executor.shutdown(wait=False)
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        'fromBlock': from_block,
+        'toBlock': to_block,
+        'failed': len(failed),
+        'processed': len(results),
+        'elapsed': round(elapsed, 3),
+        'txPerMinute': round(len(results) / elapsed * 60, 2) if elapsed else 0.0,
+        'concurrency': concurrency,
+    }
+    await emit(dict(summary, type='scan_complete'))
+    return results, summary
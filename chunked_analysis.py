@@ -0,0 +1,120 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# Трейс больше этого числа токенов (оценка: 4 символа на токен) анализируется по частям
+CHUNKED_ANALYSIS_TOKENS = int(os.getenv('CHUNKED_ANALYSIS_TOKENS', '150000'))
+
+# Размер одной части и число частей, которые анализируются одновременно
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', '30000'))
+CHUNK_CONCURRENCY = int(os.getenv('CHUNK_CONCURRENCY', '4'))
+
+# Сколько последних шагов перед REVERT попадает в итоговый промпт целиком
+REDUCE_TAIL_STEPS = 30
+
+def split_frames(trace):
+    """Делит трейс на участки одного фрейма: новый участок начинается при смене глубины"""
+    segments = []
+    for op in trace:
+        if segments and segments[-1][-1].get('depth') == op.get('depth'):
+            segments[-1].append(op)
+        else:
+            segments.append([op])
+    return segments
+
+def split_chunks(trace, max_chars=CHUNK_TOKENS * 4):
+    """
+    Собирает участки фреймов в части не больше max_chars символов JSON.
+    Фрейм больше одной части режется по шагам.
+    """
+    chunks = []
+    current, current_size = [], 0
+    for segment in split_frames(trace):
+        for op in segment:
+            size = len(json.dumps(op))
+            if current and current_size + size > max_chars:
+                chunks.append(current)
+                current, current_size = [], 0
+            current.append(op)
+            current_size += size
+        # Граница фрейма - удобное место для новой части, если текущая заполнена больше чем наполовину
+        if current_size > max_chars // 2:
+            chunks.append(current)
+            current, current_size = [], 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+def build_map_prompt(index, total, chunk):
+    depths = [op.get('depth', 0) for op in chunk]
+    return f"""You are analyzing part {index + 1} of {total} of an Ethereum transaction trace that ends in a REVERT. The parts are analyzed separately and your summary will be combined with the others.
+
+Summarize what happens in this part in at most 200 words:
+- calls made (target address and function selector from input_data)
+- comparisons (LT, GT, EQ, ISZERO) and JUMPI conditions that look like checks, with their values
+- SLOAD and SSTORE keys and values
+- anything that looks like a failing check or an unusual value
+
+Refer to steps by pc and depth. Don't describe other parts of the trace and don't give recommendations.
+
+Trace part (call depth {min(depths)}-{max(depths)}, {len(chunk)} steps):
+{json.dumps(chunk, indent=2)}"""
+
+def build_reduce_prompt(header, summaries, tail, source_code):
+    parts = '\n\n'.join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(summaries))
+    return f"""{header}
+
+The trace was too large to send in full. It was split along call-frame boundaries and each part was summarized separately. The summaries are listed in execution order, followed by the last steps before the REVERT.
+
+Source Code Context:
+```solidity
+{source_code}
+```
+
+Part summaries:
+{parts}
+
+Last steps before the REVERT:
+{json.dumps(tail, indent=2)}
+
+Your analysis should include:
+1. Identify the sequence of operations that led to the REVERT
+2. Explain what each operation does and how it contributed to the failure
+3. If there's a revert message, decode and explain it
+4. Suggest potential fixes or improvements
+
+Don't ask questions and don't ask user to provide more information, just provide the analysis.
+Don't include trace statistics, just the analysis.
+
+Please format your response in a clear, structured way:
+1. Summary of the issue
+2. Detailed analysis of the trace
+3. Root cause
+4. Recommendations"""
+
+def analyze_chunked(trace, header, source_code, generate_map, generate_reduce):
+    """
+    Map-reduce анализ большого трейса: части суммируются параллельно,
+    итоговый отчёт строится по их сводкам. generate_* принимают промпт и возвращают текст.
+    Возвращает (анализ, число частей, все отправленные промпты).
+    """
+    chunks = split_chunks(trace)
+    prompts = [build_map_prompt(i, len(chunks), chunk) for i, chunk in enumerate(chunks)]
+    print(f"Trace split into {len(chunks)} parts for chunked analysis")
+
+    def summarize(prompt):
+        try:
+            return generate_map(prompt)
+        except Exception as e:
+            print(f"Error summarizing trace part: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), CHUNK_CONCURRENCY))) as executor:
+        summaries = list(executor.map(summarize, prompts))
+    if not any(summaries):
+        raise RuntimeError('All trace parts failed to summarize')
+    summaries = [summary or '(summary unavailable)' for summary in summaries]
+
+    reduce_prompt = build_reduce_prompt(header, summaries, trace[-REDUCE_TAIL_STEPS:], source_code)
+    prompts.append(reduce_prompt)
+    return generate_reduce(reduce_prompt), len(chunks), prompts
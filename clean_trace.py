@@ -2,6 +2,7 @@ import json
 import sys
 import traceback
 from process_traces import process_trace as get_trace
+import metrics
 
 def clean_trace_to_first_revert(trace_data):
     """
@@ -42,11 +43,15 @@ def clean_trace(trace_data):
     Очищает трейс и возвращает результат
     """
     try:
-        cleaned_trace = clean_trace_to_first_revert(trace_data)
+        with metrics.span('clean_trace_to_first_revert') as span:
+            cleaned_trace = clean_trace_to_first_revert(trace_data)
+            span['steps'] = len(cleaned_trace or [])
         if cleaned_trace:
             # Сохраняем очищенный трейс
-            with open('cleaned_trace.json', 'w') as f:
-                json.dump(cleaned_trace, f, indent=2)
+            with metrics.span('json.write') as span:
+                with open('cleaned_trace.json', 'w') as f:
+                    json.dump(cleaned_trace, f, indent=2)
+                    span['bytes_out'] = f.tell()
             print("Cleaned trace saved to cleaned_trace.json")
             return cleaned_trace
         return None
@@ -56,11 +61,14 @@ def clean_trace(trace_data):
         return None
 
 def main():
+    metrics.report_startup()
     try:
         # Читаем трейс из файла
         print("Reading trace from cleaned_trace.json...")
-        with open('cleaned_trace.json', 'r') as f:
-            trace_data = json.load(f)
+        with metrics.span('json.read') as span:
+            with open('cleaned_trace.json', 'r') as f:
+                trace_data = json.load(f)
+                span['bytes_in'] = f.tell()
             
         # Очищаем трейс
         print("Compiling sources...")
@@ -3,13 +3,36 @@ import sys
 import requests
 import time
 import traceback
-from process_traces import process_struct_logs
+from process_traces import process_struct_logs, make_trace_state, rpc_call, hex_to_int, NODE_URL, TRACE_MODE, TRACE_CONFIGS
+from recorder import record
+from revert_decoder import decode_revert_data
+from clean_trace import clean_trace_to_first_revert
+import metrics
 
-def get_trace_call(params):
+# structLog трейс в том же режиме, что и в process_traces.py
+STRUCT_LOG_CONFIG = TRACE_CONFIGS[TRACE_MODE]
+
+# Компактный трейс вызовов для сводки по вариантам
+CALL_TRACER_CONFIG = {
+    "tracer": "callTracer"
+}
+
+def get_block_number():
+    """
+    Номер последнего блока в hex
+    """
+    return rpc_call('eth_blockNumber', [])
+
+def get_trace_call(params, block='latest', state_overrides=None, trace_config=None):
     """
-    Получает трейс через debug_traceCall
+    Получает трейс через debug_traceCall.
+    block фиксирует состояние, state_overrides подменяет балансы, код и storage аккаунтов.
     """
     try:
+        config = dict(trace_config or STRUCT_LOG_CONFIG)
+        if state_overrides:
+            config['stateOverrides'] = state_overrides
+            
         # Формируем параметры для debug_traceCall
         trace_params = {
             'jsonrpc': '2.0',
@@ -19,32 +42,32 @@ def get_trace_call(params):
                     'from': params['from'],
                     'to': params['to'],
                     'data': params['data'],
-                    'value': params.get('value', '0x0')
+                    'value': params.get('value') or '0x0'
                 },
-                'latest',  # block number
-                {
-                    "enableMemory": True,
-                    "disableStack": False,
-                    "disableStorage": False,
-                    "enableReturnData": True
-                }
+                block,
+                config
             ],
             'id': 1
         }
         
         # Отправляем запрос к ноде
-        response = requests.post(
-            '',
-            json=trace_params,
-            headers={'Content-Type': 'application/json'},
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            print(f"Error: Node returned status code {response.status_code}")
-            return None
+        with metrics.span('rpc.debug_traceCall') as span:
+            response = requests.post(
+                NODE_URL,
+                json=trace_params,
+                headers={'Content-Type': 'application/json'},
+                timeout=30
+            )
+            span['bytes_in'] = len(response.content)
+            if response.status_code != 200:
+                span['error'] = True
+                print(f"Error: Node returned status code {response.status_code}")
+                return None
+            result = response.json()
+            if isinstance(result.get('result'), dict) and 'structLogs' in result['result']:
+                span['steps'] = len(result['result']['structLogs'])
             
-        result = response.json()
+        record('rpc', trace_params, result)
         if 'error' in result:
             print(f"Error from node: {result['error']}")
             return None
@@ -56,7 +79,62 @@ def get_trace_call(params):
         traceback.print_exc()
         return None
 
+def build_variant(base, variant):
+    """Параметры вызова варианта: base с подменёнными полями"""
+    params = dict(base)
+    for key in ('from', 'to', 'data', 'value'):
+        if variant.get(key) is not None:
+            params[key] = variant[key]
+    return params
+
+def summarize_call(params, block, state_overrides=None):
+    """
+    Выполняет вариант через callTracer и возвращает компактную сводку:
+    успех, причина реверта и потраченный газ.
+    """
+    result = get_trace_call(params, block, state_overrides, CALL_TRACER_CONFIG)
+    if result is None:
+        return {'success': False, 'error': 'trace failed'}
+    summary = {
+        'success': 'error' not in result,
+        'gasUsed': hex_to_int(result.get('gasUsed', '0x0')),
+    }
+    if not summary['success']:
+        summary['error'] = result.get('error')
+        summary['revert'] = decode_revert_data(result.get('output'))
+        if result.get('revertReason'):
+            summary['revert']['reason'] = result['revertReason']
+    return summary
+
+def trace_variant(params, block, state_overrides=None):
+    """
+    Полный structLog трейс варианта, обрезанный от CALL до первого REVERT.
+    Возвращает None, если вариант не ревертится.
+    """
+    trace = get_trace_call(params, block, state_overrides)
+    if not trace:
+        return None
+    state = make_trace_state(params['data'], params['to'], block)
+    processed_trace = process_struct_logs(trace['structLogs'], state=state)
+    
+    # Как и в process_trace, добавляем внешний вызов в начало трейса
+    processed_trace.insert(0, {
+        'op': 'CALL',
+        'args': {
+            'from': params['from'],
+            'to': params['to'],
+            'value': params.get('value') or '0x0',
+            'input_data': params['data']
+        },
+        'pc': 0,
+        'depth': 0,
+        'gas': 0,
+        'gasCost': 0
+    })
+    return clean_trace_to_first_revert(processed_trace)
+
 def main():
+    metrics.report_startup()
     try:
         # Получаем параметры из stdin
         params = json.loads(sys.argv[1])
@@ -67,13 +145,18 @@ def main():
             sys.exit(1)
             
         # Обрабатываем трейс используя функцию из process_traces.py
-        processed_trace = process_struct_logs(trace['structLogs'])
+        with metrics.span('process_struct_logs') as span:
+            state = make_trace_state(params['data'], params['to'])
+            processed_trace = process_struct_logs(trace['structLogs'], state=state)
+            span['steps'] = len(processed_trace)
         if not processed_trace:
             sys.exit(1)
             
         # Сохраняем результат
-        with open('cleaned_trace.json', 'w') as f:
-            json.dump(processed_trace, f, indent=2)
+        with metrics.span('json.write') as span:
+            with open('cleaned_trace.json', 'w') as f:
+                json.dump(processed_trace, f, indent=2)
+                span['bytes_out'] = f.tell()
             
     except Exception as e:
         print(f"Error in main: {str(e)}")
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import hashlib
+import metrics
+from process_traces import get_code
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Индекс отпечаток -> прошлый анализ хранится на диске, чтобы его видели все скрипты
+FINGERPRINT_DIR = os.getenv('FINGERPRINT_DIR', os.path.join(BASE_DIR, 'fingerprints'))
+FINGERPRINT_CACHE = os.getenv('FINGERPRINT_CACHE', '1') == '1'
+
+FINGERPRINT_LOOKUPS = metrics.REGISTRY.counter(
+    'revert_fingerprint_lookups_total', 'Revert fingerprint index lookups by outcome', ['result'])
+
+CALL_OPS = ('CALL', 'DELEGATECALL', 'STATICCALL', 'CALLCODE')
+
+def get_call_path(trace):
+    """Последовательность вызовов в трейсе: (op, адрес, селектор)"""
+    path = []
+    for op in trace:
+        if op['op'] in CALL_OPS:
+            input_data = op['args'].get('input_data') or '0x'
+            path.append((op['op'], (op['args'].get('to') or '').lower(), input_data[:10]))
+    return path
+
+def get_revert_address(trace):
+    """Адрес контракта, код которого выполнил последний REVERT"""
+    frames = {}
+    address = None
+    for op in trace:
+        if op['op'] in CALL_OPS:
+            # Вызов на глубине d исполняет код адреса to на глубине d + 1
+            frames[op['depth'] + 1] = op['args'].get('to')
+        elif op['op'] == 'REVERT':
+            address = frames.get(op['depth'])
+    return address
+
+def get_code_hash(address):
+    """sha256 байткода контракта (нужен только как стабильный ключ, не как keccak codehash)"""
+    code = get_code(address) if address else None
+    if not code or code == '0x':
+        return None
+    return '0x' + hashlib.sha256(bytes.fromhex(code[2:])).hexdigest()
+
+def compute_fingerprint(trace, revert, code_hash, model, prompt_version):
+    """
+    Отпечаток реверта: хэш кода контракта, селектор, pc реверта, данные реверта и путь вызовов.
+    Модель и версия промпта входят в отпечаток, чтобы не переиспользовать анализы старого формата.
+    """
+    call_path = get_call_path(trace)
+    components = {
+        'code_hash': code_hash,
+        'selector': call_path[0][2] if call_path else '0x',
+        'revert_pc': revert.get('pc') if revert else None,
+        'revert_data': revert.get('message_hex') if revert else None,
+        'call_path': call_path,
+        'model': model,
+        'prompt_version': prompt_version,
+    }
+    payload = json.dumps(components, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest(), components
+
+class FingerprintIndex:
+    """Индекс отпечаток -> анализ, по одному JSON файлу на отпечаток"""
+    def __init__(self, index_dir=FINGERPRINT_DIR):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+
+    def path(self, fingerprint):
+        return os.path.join(self.index_dir, fingerprint + '.json')
+
+    def get(self, fingerprint):
+        try:
+            with open(self.path(fingerprint), 'r') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            metrics.count(FINGERPRINT_LOOKUPS.name, result='miss')
+            return None
+        metrics.count(FINGERPRINT_LOOKUPS.name, result='hit')
+        return entry
+
+    def put(self, fingerprint, entry):
+        entry = dict(entry, createdAt=time.time())
+        tmp_path = self.path(fingerprint) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path(fingerprint))
+        return entry
+
+def is_tx_hash(value):
+    return isinstance(value, str) and value.startswith('0x') and len(value) == 66
+
+def annotate_analysis(entry, tx_hash, call_op):
+    """Подставляет в прошлый анализ данные текущей транзакции"""
+    analysis = entry['analysis']
+    source_tx = entry.get('txHash')
+    if is_tx_hash(source_tx) and is_tx_hash(tx_hash):
+        analysis = analysis.replace(source_tx, tx_hash)
+    args = call_op.get('args', {})
+    header = (
+        f"Note: this revert matches a previously analyzed failure (fingerprint {entry['fingerprint'][:16]}, "
+        f"first seen in {source_tx}). The analysis below is reused for this transaction.\n"
+        f"Transaction: {tx_hash}\n"
+        f"From: {args.get('from', 'unknown')}\n"
+        f"Value: {args.get('value', '0x0')}\n"
+        f"Input: {args.get('input_data', '0x')}\n\n"
+    )
+    return header + analysis
+
+def hit_rate():
+    """Доля попаданий в индекс отпечатков за время работы процесса"""
+    hits = FINGERPRINT_LOOKUPS.values.get(('hit',), 0)
+    misses = FINGERPRINT_LOOKUPS.values.get(('miss',), 0)
+    total = hits + misses
+    return hits / total if total else 0.0
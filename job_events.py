@@ -0,0 +1,90 @@
+import os
+import time
+import uuid
+from collections import deque, OrderedDict
+import metrics
+
+# Сколько последних событий хранится у задачи для resume
+JOB_LOG_SIZE = int(os.getenv('JOB_LOG_SIZE', '200'))
+
+# Сколько секунд лог завершённой задачи доступен для resume
+JOB_LOG_TTL = float(os.getenv('JOB_LOG_TTL', '600'))
+
+# Предел числа задач в памяти; при переполнении первыми удаляются самые старые завершённые
+MAX_JOB_LOGS = int(os.getenv('MAX_JOB_LOGS', '1000'))
+
+RESUMES = metrics.REGISTRY.counter(
+    'revert_job_resumes_total', 'Resume requests by outcome', ['result'])
+
+class Job:
+    """Задача и её ограниченный лог событий с порядковыми номерами"""
+    def __init__(self, kind, tx_hash=None, max_events=JOB_LOG_SIZE):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.tx_hash = tx_hash.lower() if tx_hash else None
+        self.events = deque(maxlen=max_events)
+        self.seq = 0
+        self.finished_at = None
+
+    def record(self, message):
+        """Добавляет событие в лог и возвращает его с jobId и seq"""
+        self.seq += 1
+        message = dict(message, jobId=self.id, seq=self.seq)
+        self.events.append(message)
+        return message
+
+    def events_after(self, seq):
+        """
+        События с номером больше seq. Второе значение - True, если часть нужных событий
+        уже вытеснена из лога.
+        """
+        events = [event for event in self.events if event['seq'] > seq]
+        first = self.events[0]['seq'] if self.events else self.seq + 1
+        return events, seq + 1 < first
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+class JobRegistry:
+    """Задачи по id и последняя задача по хэшу транзакции"""
+    def __init__(self, ttl=JOB_LOG_TTL, max_jobs=MAX_JOB_LOGS):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.by_tx = {}
+
+    def create(self, kind, tx_hash=None):
+        self.expire()
+        job = Job(kind, tx_hash)
+        self.jobs[job.id] = job
+        # Повторный запрос идущей задачи не подменяет её: resume по хэшу должен найти задачу с полным логом
+        current = self.by_tx.get(job.tx_hash)
+        if job.tx_hash and (current is None or current.finished):
+            self.by_tx[job.tx_hash] = job
+        return job
+
+    def finish(self, job):
+        job.finished_at = time.time()
+
+    def get(self, job_id=None, tx_hash=None):
+        self.expire()
+        if job_id:
+            return self.jobs.get(job_id)
+        if tx_hash:
+            return self.by_tx.get(tx_hash.lower())
+        return None
+
+    def remove(self, job):
+        del self.jobs[job.id]
+        if self.by_tx.get(job.tx_hash) is job:
+            del self.by_tx[job.tx_hash]
+
+    def expire(self):
+        now = time.time()
+        for job in [job for job in self.jobs.values() if job.finished and now - job.finished_at > self.ttl]:
+            self.remove(job)
+        if len(self.jobs) > self.max_jobs:
+            finished = [job for job in self.jobs.values() if job.finished]
+            for job in finished[:len(self.jobs) - self.max_jobs]:
+                self.remove(job)
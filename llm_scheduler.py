@@ -0,0 +1,167 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+import metrics
+from rate_limit import TokenBucket
+
+# Сколько запросов к модели может идти одновременно и сколько новых запросов в секунду
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '4'))
+LLM_RATE = float(os.getenv('LLM_RATE')) if os.getenv('LLM_RATE') else None
+
+# Повторы: число повторов и начальная задержка экспоненциального backoff в секундах
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_BACKOFF = float(os.getenv('LLM_BACKOFF', '1'))
+LLM_MAX_BACKOFF = float(os.getenv('LLM_MAX_BACKOFF', '30'))
+
+# Таймаут одной попытки и общий срок на все попытки одной задачи
+LLM_ATTEMPT_TIMEOUT = float(os.getenv('LLM_ATTEMPT_TIMEOUT', '120'))
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', '300'))
+
+# Если попытка не ответила за столько секунд, параллельно отправляется второй запрос
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER')) if os.getenv('LLM_HEDGE_AFTER') else None
+
+LLM_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'revert_llm_queue_depth', 'Model requests waiting for a concurrency slot')
+LLM_ATTEMPTS = metrics.REGISTRY.counter(
+    'revert_llm_attempts_total', 'Model request attempts by outcome', ['result'])
+LLM_HEDGES = metrics.REGISTRY.counter(
+    'revert_llm_hedges_total', 'Hedged model requests by the attempt that answered first', ['winner'])
+
+# Ошибки, после которых запрос имеет смысл повторить: таймауты, rate limit и ошибки сервера
+RETRYABLE_ERRORS = {
+    'TimeoutError', 'Timeout', 'ReadTimeout', 'ConnectTimeout', 'ConnectionError',
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError',
+    'DeadlineExceeded', 'GatewayTimeout', 'BadGateway',
+}
+
+class DeadlineExceeded(Exception):
+    """Срок задачи истёк до получения ответа модели"""
+
+def is_retryable(error):
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+class LLMScheduler:
+    """
+    Общая очередь запросов к модели: лимит одновременных запросов, token bucket,
+    повторы с jitter, срок на задачу и hedged запросы.
+    """
+    def __init__(self, concurrency=LLM_CONCURRENCY, rate=LLM_RATE, max_retries=LLM_MAX_RETRIES,
+                 backoff=LLM_BACKOFF, max_backoff=LLM_MAX_BACKOFF, attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+                 hedge_after=LLM_HEDGE_AFTER):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.limiter = TokenBucket(rate) if rate else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.attempt_timeout = attempt_timeout
+        self.hedge_after = hedge_after
+        # Слот занят, пока запрос реально идёт, поэтому потоков нужно не больше concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='llm')
+
+    def acquire(self, deadline):
+        """Ждёт свободный слот и токен rate limit не дольше deadline"""
+        metrics.count(LLM_QUEUE_DEPTH.name, 1)
+        try:
+            with metrics.span('llm.queue_wait'):
+                if not self.slots.acquire(timeout=max(0.0, deadline - time.time())):
+                    raise DeadlineExceeded('Timed out waiting for a model slot')
+                if self.limiter:
+                    delay = self.limiter.reserve()
+                    if time.time() + delay > deadline:
+                        self.slots.release()
+                        raise DeadlineExceeded('Timed out waiting for the model rate limit')
+                    time.sleep(delay)
+        finally:
+            metrics.count(LLM_QUEUE_DEPTH.name, -1)
+
+    async def acquire_async(self, deadline):
+        """То же, что acquire, но без блокировки event loop"""
+        metrics.count(LLM_QUEUE_DEPTH.name, 1)
+        try:
+            with metrics.span('llm.queue_wait'):
+                while not self.slots.acquire(blocking=False):
+                    if time.time() >= deadline:
+                        raise DeadlineExceeded('Timed out waiting for a model slot')
+                    await asyncio.sleep(0.05)
+                if self.limiter:
+                    await self.limiter.acquire_async()
+        finally:
+            metrics.count(LLM_QUEUE_DEPTH.name, -1)
+
+    def release(self):
+        self.slots.release()
+
+    def submit(self, model, prompt, timeout):
+        # Слот освобождается, когда запрос завершился, даже если его результат уже не ждут
+        future = self.executor.submit(model.generate_content, prompt, request_options={'timeout': timeout})
+        future.add_done_callback(lambda _: self.release())
+        return future
+
+    def attempt(self, model, prompt, deadline):
+        """Одна попытка: основной запрос и, если он медлит, hedged запрос"""
+        self.acquire(deadline)
+        timeout = min(self.attempt_timeout, deadline - time.time())
+        if timeout <= 0:
+            self.release()
+            raise DeadlineExceeded('Deadline reached before the model request was sent')
+        started = time.monotonic()
+        futures = {self.submit(model, prompt, timeout): 'primary'}
+
+        if self.hedge_after and self.hedge_after < timeout:
+            done, _ = wait(futures, timeout=self.hedge_after)
+            # Hedge не ждёт очереди: без свободного слота и токена он не отправляется
+            if not done and self.slots.acquire(blocking=False):
+                if self.limiter is None or self.limiter.try_acquire():
+                    futures[self.submit(model, prompt, timeout)] = 'hedge'
+                else:
+                    self.release()
+        hedged = len(futures) > 1
+
+        error = None
+        while futures:
+            remaining = timeout - (time.monotonic() - started)
+            done, _ = wait(futures, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                metrics.count(LLM_ATTEMPTS.name, result='timeout')
+                raise TimeoutError(f'Model did not answer within {timeout:.1f}s')
+            for future in done:
+                name = futures.pop(future)
+                if future.exception() is None:
+                    metrics.count(LLM_ATTEMPTS.name, result='ok')
+                    if hedged:
+                        metrics.count(LLM_HEDGES.name, winner=name)
+                    return future.result()
+                metrics.count(LLM_ATTEMPTS.name, result='error')
+                error = future.exception()
+        raise error
+
+    def generate(self, model, prompt, deadline=None):
+        """
+        Отправляет промпт модели через очередь и возвращает ответ.
+        deadline - время (time.time()), после которого попытки прекращаются.
+        """
+        deadline = deadline or time.time() + LLM_DEADLINE
+        retries = 0
+        while True:
+            try:
+                return self.attempt(model, prompt, deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if retries >= self.max_retries or not is_retryable(e):
+                    raise
+                retries += 1
+                # Full jitter: случайная задержка до экспоненциально растущего предела
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retries - 1)))
+                if time.time() + delay >= deadline:
+                    raise DeadlineExceeded(f'Deadline reached after {retries} attempts: {e}') from e
+                print(f"Model request failed ({e}), retry {retries}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+
+SCHEDULER = LLMScheduler()
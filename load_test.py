@@ -0,0 +1,111 @@
+import json
+import time
+import asyncio
+import argparse
+import websockets
+
+def percentile(values, q):
+    """Возвращает q-й перцентиль (0..100) списка значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+async def run_client(url, tx_hash, timeout):
+    """Отправляет один start и измеряет длительность каждого этапа по событиям сервера"""
+    durations = {}
+    async with websockets.connect(url, max_size=None) as websocket:
+        started = time.perf_counter()
+        await websocket.send(json.dumps({'action': 'start', 'txHash': tx_hash}))
+
+        current_stage = None
+        stage_started = started
+        deadline = started + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                durations['error'] = 'timeout'
+                break
+            message = json.loads(await asyncio.wait_for(websocket.recv(), remaining))
+            # Сервер рассылает события всех задач, берём только свои
+            if message.get('txHash') not in (None, tx_hash):
+                continue
+            now = time.perf_counter()
+            if message.get('type') == 'stage':
+                if current_stage:
+                    durations[current_stage] = now - stage_started
+                current_stage = message['stage']
+                stage_started = now
+            elif message.get('type') == 'complete':
+                if current_stage:
+                    durations[current_stage] = now - stage_started
+                durations['total'] = now - started
+                break
+            elif message.get('type') == 'error':
+                durations['error'] = message.get('message')
+                break
+    return durations
+
+async def run_load(url, tx_hashes, clients, rounds, timeout):
+    """Запускает clients параллельных клиентов, каждый выполняет rounds запросов"""
+    async def client_loop(client_id):
+        results = []
+        for i in range(rounds):
+            tx_hash = tx_hashes[(client_id * rounds + i) % len(tx_hashes)]
+            try:
+                results.append(await run_client(url, tx_hash, timeout))
+            except Exception as e:
+                results.append({'error': str(e)})
+        return results
+
+    per_client = await asyncio.gather(*[client_loop(i) for i in range(clients)])
+    return [result for results in per_client for result in results]
+
+def summarize(results):
+    """Считает p50/p95/p99 по каждому этапу"""
+    stages = {}
+    errors = 0
+    for result in results:
+        if 'error' in result:
+            errors += 1
+            continue
+        for stage, duration in result.items():
+            stages.setdefault(stage, []).append(duration)
+
+    summary = {'runs': len(results), 'errors': errors, 'stages': {}}
+    for stage, values in stages.items():
+        summary['stages'][stage] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+        }
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Opens N WebSocket clients against run.py and reports per-stage latency')
+    parser.add_argument('tx_hashes', nargs='+', help='Transaction hashes to submit (cycled across clients)')
+    parser.add_argument('--url', default='ws://127.0.0.1:8765')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=1, help='Requests per client')
+    parser.add_argument('--timeout', type=float, default=300.0, help='Per-request timeout in seconds')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    results = asyncio.run(run_load(args.url, args.tx_hashes, args.clients, args.rounds, args.timeout))
+    summary = summarize(results)
+    summary['wall_time'] = time.perf_counter() - started
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"Runs: {summary['runs']}, errors: {summary['errors']}, wall time: {summary['wall_time']:.2f}s")
+    print(f"{'stage':<35} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for stage, stats in summary['stages'].items():
+        print(f"{stage:<35} {stats['count']:>6} {stats['p50']:>8.3f}s {stats['p95']:>8.3f}s {stats['p99']:>8.3f}s")
+
+if __name__ == "__main__":
+    main()
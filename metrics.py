@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Скрипты, запущенные из run.py, печатают спаны в stdout строками с этим префиксом
+METRIC_PREFIX = '__metric__ '
+
+# run.py выставляет METRICS_PIPE=1 дочерним процессам, чтобы спаны уходили в родительский процесс
+METRICS_PIPE = os.getenv('METRICS_PIPE') == '1'
+
+# Границы бакетов гистограмм длительностей, в секундах
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Границы бакетов для размеров трейсов, в шагах
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+class Counter:
+    """Счётчик с метками в формате Prometheus"""
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, key)} {value}')
+        return lines
+
+class Gauge(Counter):
+    """Значение, которое может расти и уменьшаться"""
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами в формате Prometheus"""
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total, value_sum) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = format_labels(self.labels + ('le',), key + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.labels + ('le',), key + ('+Inf',))
+                lines.append(f'{self.name}_bucket{labels} {total}')
+                lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {value_sum}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, key)} {total}')
+        return lines
+
+class Registry:
+    """Набор метрик процесса"""
+    def __init__(self):
+        self.metrics = []
+
+    def get(self, name):
+        for metric in self.metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, labels=()):
+        metric = Gauge(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'revert_stage_duration_seconds', 'Duration of pipeline stages', ['stage'])
+CALL_SECONDS = REGISTRY.histogram(
+    'revert_call_duration_seconds', 'Duration of outbound calls and local I/O', ['call'])
+CALL_ERRORS = REGISTRY.counter(
+    'revert_call_errors_total', 'Outbound calls that raised an error', ['call'])
+CALL_BYTES = REGISTRY.counter(
+    'revert_call_bytes_total', 'Bytes transferred by outbound calls and local I/O', ['call', 'direction'])
+TRACE_STEPS = REGISTRY.histogram(
+    'revert_trace_steps', 'Number of steps in fetched and processed traces', ['call'], SIZE_BUCKETS)
+JOBS = REGISTRY.counter(
+    'revert_jobs_total', 'Finished analysis jobs', ['kind', 'status'])
+JOB_SECONDS = REGISTRY.histogram(
+    'revert_job_duration_seconds', 'End-to-end duration of analysis jobs', ['kind'])
+
+class JobTimings:
+    """Разбивка времени одной задачи по этапам и внешним вызовам"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.calls = {}
+
+    def add(self, span):
+        seconds = span['seconds']
+        if span['kind'] == 'stage':
+            self.stages[span['name']] = self.stages.get(span['name'], 0.0) + seconds
+            return
+        call = self.calls.get(span['name'])
+        if call is None:
+            call = self.calls[span['name']] = {'count': 0, 'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0}
+        call['count'] += 1
+        call['seconds'] += seconds
+        call['bytes_in'] += span.get('bytes_in', 0)
+        call['bytes_out'] += span.get('bytes_out', 0)
+        if 'steps' in span:
+            call['steps'] = span['steps']
+
+    def as_dict(self):
+        return {
+            'total': round(time.perf_counter() - self.started, 4),
+            'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'calls': {
+                name: dict(call, seconds=round(call['seconds'], 4))
+                for name, call in self.calls.items()
+            }
+        }
+
+def observe(span, timings=None):
+    """Записывает завершённый спан в метрики процесса и в разбивку задачи"""
+    name = span['name']
+    if span['kind'] == 'count':
+        counter = REGISTRY.get(name)
+        if counter is not None:
+            counter.inc(span.get('amount', 1), **span.get('labels', {}))
+        return
+    if span['kind'] == 'stage':
+        STAGE_SECONDS.observe(span['seconds'], stage=name)
+    else:
+        CALL_SECONDS.observe(span['seconds'], call=name)
+        if span.get('error'):
+            CALL_ERRORS.inc(call=name)
+        if span.get('bytes_in'):
+            CALL_BYTES.inc(span['bytes_in'], call=name, direction='in')
+        if span.get('bytes_out'):
+            CALL_BYTES.inc(span['bytes_out'], call=name, direction='out')
+        if 'steps' in span:
+            TRACE_STEPS.observe(span['steps'], call=name)
+    if timings is not None:
+        timings.add(span)
+
+def record(span, timings=None):
+    """Отправляет спан в родительский процесс или записывает его локально"""
+    if METRICS_PIPE:
+        sys.stdout.write(METRIC_PREFIX + json.dumps(span) + '\n')
+        sys.stdout.flush()
+    else:
+        observe(span, timings)
+
+def count(name, amount=1, **labels):
+    """Увеличивает счётчик name; из дочернего процесса счётчик передаётся в run.py"""
+    record({'kind': 'count', 'name': name, 'amount': amount, 'labels': labels})
+
+def parse_line(line):
+    """Возвращает спан, если строка вывода скрипта является метрикой"""
+    if not line.startswith(METRIC_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(METRIC_PREFIX):])
+    except json.JSONDecodeError:
+        return None
+
+@contextmanager
+def span(name, kind='call', timings=None):
+    """
+    Замеряет длительность блока. В словарь, который отдаёт менеджер,
+    можно дописать bytes_in, bytes_out и steps.
+    """
+    data = {'kind': kind, 'name': name}
+    started = time.perf_counter()
+    try:
+        yield data
+    except BaseException:
+        data['error'] = True
+        raise
+    finally:
+        data['seconds'] = time.perf_counter() - started
+        record(data, timings)
+
+def report_startup():
+    """Сообщает время запуска интерпретатора и импортов дочернего скрипта"""
+    spawned = os.getenv('SPAWN_TS')
+    if METRICS_PIPE and spawned:
+        record({'kind': 'call', 'name': 'subprocess.startup', 'seconds': time.time() - float(spawned)})
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import metrics
+from revert_decoder import get_revert_data
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# MODEL_ROUTING=0 отправляет все анализы в стандартный уровень
+MODEL_ROUTING = os.getenv('MODEL_ROUTING', '1') == '1'
+
+# Уровни: модель и вариант промпта. Простые реверты идут в быструю модель с коротким промптом,
+# большое окно контекста используется только для сложных
+TIERS = {
+    'fast': {'model': os.getenv('MODEL_FAST', 'gemini-1.5-flash-8b'), 'prompt': 'brief'},
+    'standard': {'model': os.getenv('MODEL_STANDARD', 'gemini-1.5-flash'), 'prompt': 'full'},
+    'deep': {'model': os.getenv('MODEL_DEEP', 'gemini-1.5-pro'), 'prompt': 'full'},
+}
+
+# Пороги оценки сложности: ниже ROUTER_FAST_BELOW - fast, от ROUTER_DEEP_FROM - deep
+ROUTER_FAST_BELOW = float(os.getenv('ROUTER_FAST_BELOW', '2'))
+ROUTER_DEEP_FROM = float(os.getenv('ROUTER_DEEP_FROM', '6'))
+
+# Промпт больше этого числа токенов (оценка: 4 символа на токен) всегда идёт в deep
+ROUTER_DEEP_TOKENS = int(os.getenv('ROUTER_DEEP_TOKENS', '200000'))
+
+# Цена в USD за миллион токенов (вход, выход), нужна только для сравнения уровней в логе
+PRICES = {
+    'gemini-1.5-flash-8b': (0.0375, 0.15),
+    'gemini-1.5-flash': (0.075, 0.30),
+    'gemini-1.5-pro': (1.25, 5.00),
+}
+
+# Решения роутера и их результаты, по одному JSON на строку
+ROUTING_LOG = os.getenv('ROUTING_LOG', os.path.join(BASE_DIR, 'routing_log.jsonl'))
+
+ROUTES = metrics.REGISTRY.counter(
+    'revert_model_routes_total', 'Analyses routed to each model tier', ['tier'])
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+def get_features(revert_info, contract_info):
+    """Признаки сложности реверта: размер трейса, глубина вызовов, причина реверта и объём исходников"""
+    trace = revert_info['trace']
+    depths = [op.get('depth', 0) for op in trace]
+    revert = get_revert_data(trace) or {}
+    sources = contract_info.get('sources', '')
+    if not isinstance(sources, str):
+        sources = json.dumps(sources)
+    return {
+        'steps': len(trace),
+        'depth': max(depths) - min(depths) if depths else 0,
+        'calls': sum(1 for op in trace if op['op'] in ('CALL', 'DELEGATECALL', 'STATICCALL', 'CALLCODE')),
+        'hasReason': revert.get('type') in ('error', 'panic'),
+        'sourceChars': len(sources),
+        'traceTokens': estimate_tokens(json.dumps(trace)),
+    }
+
+def score(features):
+    """Оценка сложности: 0 - одиночный require с сообщением, больше - глубже и запутаннее"""
+    value = min(features['steps'] / 250, 4.0)
+    value += min(features['depth'], 10) * 0.5
+    value += min(features['calls'], 10) * 0.2
+    if not features['hasReason']:
+        # Без сообщения причину приходится восстанавливать по опкодам
+        value += 2.0
+    if not features['sourceChars']:
+        value += 1.0
+    return round(value, 3)
+
+def route(revert_info, contract_info):
+    """Выбирает уровень модели и вариант промпта для анализа"""
+    features = get_features(revert_info, contract_info)
+    value = score(features)
+    prompt_tokens = features['traceTokens'] + features['sourceChars'] // 4
+    if not MODEL_ROUTING:
+        tier = 'standard'
+    elif prompt_tokens >= ROUTER_DEEP_TOKENS or value >= ROUTER_DEEP_FROM:
+        tier = 'deep'
+    elif value < ROUTER_FAST_BELOW:
+        tier = 'fast'
+    else:
+        tier = 'standard'
+    metrics.count(ROUTES.name, tier=tier)
+    return dict(TIERS[tier], tier=tier, score=value, features=features)
+
+def estimate_cost(model, prompt, response_text):
+    prices = PRICES.get(model)
+    if not prices:
+        return None
+    return round(
+        (estimate_tokens(prompt) * prices[0] + estimate_tokens(response_text) * prices[1]) / 1_000_000, 6)
+
+def log_outcome(decision, tx_hash, seconds, prompt, response_text=None, error=None):
+    """Дописывает решение роутера и его результат в ROUTING_LOG для подбора порогов"""
+    entry = {
+        'ts': time.time(),
+        'txHash': tx_hash,
+        'tier': decision['tier'],
+        'model': decision['model'],
+        'prompt': decision['prompt'],
+        'score': decision['score'],
+        'features': decision['features'],
+        'seconds': round(seconds, 3),
+        'promptTokens': estimate_tokens(prompt),
+        'responseTokens': estimate_tokens(response_text or ''),
+        'costUsd': estimate_cost(decision['model'], prompt, response_text or ''),
+        'chunks': decision.get('chunks'),
+        'error': error,
+    }
+    try:
+        # Строка пишется одним write в режиме append, поэтому процессы не перемешивают строки
+        with open(ROUTING_LOG, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        print(f"Error writing routing log: {e}")
+    return entry
@@ -1,39 +1,51 @@
 import requests
 import json
+import os
 import sys
+from recorder import record
+from trace_state import TraceState, to_address
+import metrics
 
-# Словарь с описанием опкодов и их аргументов
-OPCODES = {
-    'ADD': {'name': 'ADD', 'args': ['a', 'b']},
-    'MUL': {'name': 'MUL', 'args': ['a', 'b']},
-    'SUB': {'name': 'SUB', 'args': ['a', 'b']},
-    'DIV': {'name': 'DIV', 'args': ['a', 'b']},
-    'MOD': {'name': 'MOD', 'args': ['a', 'b']},
-    'LT': {'name': 'LT', 'args': ['a', 'b']},
-    'GT': {'name': 'GT', 'args': ['a', 'b']},
-    'SLT': {'name': 'SLT', 'args': ['a', 'b']},
-    'SGT': {'name': 'SGT', 'args': ['a', 'b']},
-    'EQ': {'name': 'EQ', 'args': ['a', 'b']},
-    'ISZERO': {'name': 'ISZERO', 'args': ['a']},
-    'REVERT': {'name': 'REVERT', 'args': ['offset', 'size']},
-    'JUMPI': {'name': 'JUMPI', 'args': ['counter', 'condition']},
-    'JUMP': {'name': 'JUMP', 'args': ['destination']},
-    'CALLDATALOAD': {'name': 'CALLDATALOAD', 'args': ['offset']},
-    'CALLDATASIZE': {'name': 'CALLDATASIZE', 'args': []},
-    'SLOAD': {'name': 'SLOAD', 'args': ['key']},
-    'SSTORE': {'name': 'SSTORE', 'args': ['key', 'value']},
-    'CALL': {'name': 'CALL', 'args': ['gas', 'to', 'value', 'in_offset', 'in_size']},
-    'DELEGATECALL': {'name': 'DELEGATECALL', 'args': ['gas', 'to', 'in_offset', 'in_size']},
-    'STATICCALL': {'name': 'STATICCALL', 'args': ['gas', 'to', 'in_offset', 'in_size']},
-    'CALLCODE': {'name': 'CALLCODE', 'args': ['gas', 'to', 'value', 'in_offset', 'in_size']},
-    'RETURN': {'name': 'RETURN', 'args': ['offset', 'size']},
+NODE_URL = os.getenv('NODE_URL', "https://mainnet.chainnodes.org/c4aa58b5-440a-4dfc-a98f-e1fcd64d17d9")
+
+# full - geth отдаёт memory и storage на каждом шаге; stack - только стек,
+# memory и storage восстанавливаются в TraceState по операциям записи
+TRACE_MODE = os.getenv('TRACE_MODE', 'full')
+
+TRACE_CONFIGS = {
+    'full': {
+        "enableMemory": True,
+        "disableStack": False,
+        "disableStorage": False,
+        "enableReturnData": True
+    },
+    'stack': {
+        "enableMemory": False,
+        "disableStack": False,
+        "disableStorage": True,
+        "enableReturnData": False
+    },
 }
 
-def get_transaction_trace(tx_hash):
+# Словарь с описанием опкодов и их аргументов, заполняется register_decoder
+OPCODES = {}
+
+# Таблица декодеров: op -> функция(log, stack, memory, result), заполняющая args и result шага
+DECODERS = {}
+
+def register_decoder(op, args, decode=None):
+    """
+    Регистрирует декодер опкода. Без decode аргументы снимаются со стека в порядке args.
+    Опкоды без декодера пропускаются в process_struct_logs одним поиском в словаре.
+    """
+    OPCODES[op] = {'name': op, 'args': list(args)}
+    DECODERS[op] = decode or stack_decoder(args)
+
+def get_transaction_trace(tx_hash, mode=TRACE_MODE):
     """
     Получает трейс транзакции через debug_traceTransaction
     """
-    url = "https://mainnet.chainnodes.org/c4aa58b5-440a-4dfc-a98f-e1fcd64d17d9"
+    url = NODE_URL
     headers = {
         "Content-Type": "application/json"
     }
@@ -41,21 +53,21 @@ def get_transaction_trace(tx_hash):
         "method": "debug_traceTransaction",
         "params": [
             tx_hash,
-            {
-                "enableMemory": True,
-                "disableStack": False,
-                "disableStorage": False,
-                "enableReturnData": True
-            }
+            TRACE_CONFIGS[mode]
         ],
         "id": 1,
         "jsonrpc": "2.0"
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()
+        with metrics.span('rpc.debug_traceTransaction') as span:
+            response = requests.post(url, headers=headers, json=payload)
+            response.raise_for_status()
+            data = response.json()
+            span['bytes_in'] = len(response.content)
+            span['steps'] = len(data.get('result', {}).get('structLogs', []))
+        record('rpc', payload, data)
+        return data
     except requests.exceptions.RequestException as e:
         print(f"Error making request: {e}")
         return None
@@ -64,7 +76,7 @@ def get_transaction(tx_hash):
     """
     Получает данные транзакции
     """
-    url = "https://mainnet.chainnodes.org/c4aa58b5-440a-4dfc-a98f-e1fcd64d17d9"
+    url = NODE_URL
     headers = {
         "Content-Type": "application/json"
     }
@@ -76,13 +88,92 @@ def get_transaction(tx_hash):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()
+        with metrics.span('rpc.eth_getTransactionByHash') as span:
+            response = requests.post(url, headers=headers, json=payload)
+            response.raise_for_status()
+            data = response.json()
+            span['bytes_in'] = len(response.content)
+        record('rpc', payload, data)
+        return data
     except requests.exceptions.RequestException as e:
         print(f"Error making request: {e}")
         return None
 
+def rpc_call(method, params, timeout=30):
+    """
+    Выполняет JSON-RPC запрос к ноде и возвращает поле result
+    """
+    payload = {
+        "method": method,
+        "params": params,
+        "id": 1,
+        "jsonrpc": "2.0"
+    }
+    
+    try:
+        with metrics.span(f'rpc.{method}') as span:
+            response = requests.post(NODE_URL, headers={"Content-Type": "application/json"}, json=payload, timeout=timeout)
+            response.raise_for_status()
+            data = response.json()
+            span['bytes_in'] = len(response.content)
+        record('rpc', payload, data)
+        if 'error' in data:
+            print(f"Error from node: {data['error']}")
+            return None
+        return data.get('result')
+    except requests.exceptions.RequestException as e:
+        print(f"Error making request: {e}")
+        return None
+
+def rpc_batch(calls, timeout=60):
+    """
+    Выполняет batch JSON-RPC запрос. calls - список пар (method, params).
+    Возвращает список result в том же порядке (None для ошибок).
+    """
+    payload = [
+        {"method": method, "params": params, "id": i, "jsonrpc": "2.0"}
+        for i, (method, params) in enumerate(calls)
+    ]
+    if not payload:
+        return []
+    
+    try:
+        with metrics.span('rpc.batch') as span:
+            response = requests.post(NODE_URL, headers={"Content-Type": "application/json"}, json=payload, timeout=timeout)
+            response.raise_for_status()
+            data = response.json()
+            span['bytes_in'] = len(response.content)
+    except requests.exceptions.RequestException as e:
+        print(f"Error making batch request: {e}")
+        return [None] * len(calls)
+    
+    if not isinstance(data, list):
+        print(f"Error from node: {data.get('error') if isinstance(data, dict) else data}")
+        return [None] * len(calls)
+    
+    # Нода может вернуть ответы в произвольном порядке, сопоставляем их по id
+    results = [None] * len(calls)
+    for reply in data:
+        index = reply.get('id')
+        if not isinstance(index, int) or not 0 <= index < len(calls):
+            continue
+        record('rpc', payload[index], reply)
+        if 'error' not in reply:
+            results[index] = reply.get('result')
+    return results
+
+def get_code(address, block='latest'):
+    """
+    Получает байткод контракта через eth_getCode
+    """
+    return rpc_call('eth_getCode', [address, block])
+
+def make_trace_state(calldata, to, block='latest', mode=TRACE_MODE):
+    """TraceState для трейса в режиме stack, None для полного трейса"""
+    if mode != 'stack':
+        return None
+    return TraceState(calldata, to, code_lookup=lambda address: get_code(address, block))
+
 def hex_to_int(hex_str):
     """Конвертирует hex строку в int"""
     if isinstance(hex_str, str) and hex_str.startswith('0x'):
@@ -94,12 +185,16 @@ def get_memory_data(memory, offset, size):
     
     offset_int = hex_to_int(offset)
     size_int = hex_to_int(size)
+    if not size_int:
+        return "0x"
     
-    # Объединяем все слова памяти в одну строку
-    memory_str = ''.join(memory)
+    # Склеиваем только слова памяти (по 32 байта), которые покрывают нужный диапазон
+    first_word = offset_int // 32
+    last_word = (offset_int + size_int + 31) // 32
+    memory_str = ''.join(memory[first_word:last_word])
     
     # Извлекаем нужный фрагмент
-    start_pos = offset_int * 2  # *2 потому что каждый байт представлен двумя hex символами
+    start_pos = (offset_int - first_word * 32) * 2  # *2 потому что каждый байт представлен двумя hex символами
     end_pos = start_pos + size_int * 2
     
     data = memory_str[start_pos:end_pos]
@@ -119,76 +214,150 @@ def hex_to_utf8(hex_str):
     except:
         return ""
 
-def process_struct_logs(struct_logs):
+def to_signed(value):
+    """Интерпретирует 256-битное слово как знаковое число"""
+    return value - (1 << 256) if value >> 255 else value
+
+def stack_decoder(names):
+    """Декодер, который снимает аргументы со стека: верх стека - первый аргумент"""
+    def decode(log, stack, memory, result):
+        result['args'].update(zip(names, reversed(stack)))
+    return decode
+
+def compare_decoder(compare, signed=False):
+    """Декодер сравнения: значения переводятся в int один раз и сразу вычисляется результат"""
+    def decode(log, stack, memory, result):
+        a, b = stack[-1], stack[-2]
+        result['args'] = {'a': a, 'b': b}
+        a, b = int(a, 16), int(b, 16)
+        if signed:
+            a, b = to_signed(a), to_signed(b)
+        result['result'] = compare(a, b)
+    return decode
+
+def decode_iszero(log, stack, memory, result):
+    result['args'] = {'a': stack[-1]}
+    result['result'] = int(stack[-1], 16) == 0
+
+def decode_call(log, stack, memory, result):
+    # Стек для CALL/CALLCODE: [retSize, retOffset, argsSize, argsOffset, value, address, gas]
+    # Для DELEGATECALL/STATICCALL: [retSize, retOffset, argsSize, argsOffset, address, gas]
+    args = result['args']
+    args['gas'] = stack[-1]
+    args['to'] = to_address(stack[-2])
+    rest = stack[-3::-1]
+    if log['op'] in ('CALL', 'CALLCODE'):
+        args['value'] = rest[0]
+        rest = rest[1:]
+    args['in_offset'], args['in_size'], args['ret_offset'], args['ret_size'] = rest[:4]
+    args['input_data'] = get_memory_data(memory, args['in_offset'], args['in_size'])
+
+def decode_revert(log, stack, memory, result):
+    hex_full = get_memory_data(memory, stack[-1], stack[-2])
+    result['message_hex'] = hex_full
+    result['message'] = hex_to_utf8(hex_full)
+    result['args'] = {'offset': stack[-1], 'size': stack[-2]}
+
+def decode_keccak(log, stack, memory, result):
+    result['args'] = {'offset': stack[-1], 'size': stack[-2]}
+    result['args']['input_data'] = get_memory_data(memory, stack[-1], stack[-2])
+
+def log_decoder(topics):
+    """Декодер LOG0-LOG4: offset, size, топики и данные события из memory"""
+    names = ['offset', 'size'] + [f'topic{i}' for i in range(topics)]
+    def decode(log, stack, memory, result):
+        args = result['args']
+        args.update(zip(names, reversed(stack)))
+        args['data'] = get_memory_data(memory, args['offset'], args['size'])
+    return decode
+
+def decode_selfdestruct(log, stack, memory, result):
+    result['args'] = {'beneficiary': to_address(stack[-1])}
+
+for op in ('ADD', 'MUL', 'SUB', 'DIV', 'SDIV', 'MOD', 'SMOD', 'EXP', 'SIGNEXTEND'):
+    register_decoder(op, ['a', 'b'])
+register_decoder('ADDMOD', ['a', 'b', 'n'])
+register_decoder('MULMOD', ['a', 'b', 'n'])
+register_decoder('SAR', ['shift', 'value'])
+register_decoder('LT', ['a', 'b'], compare_decoder(lambda a, b: a < b))
+register_decoder('GT', ['a', 'b'], compare_decoder(lambda a, b: a > b))
+register_decoder('SLT', ['a', 'b'], compare_decoder(lambda a, b: a < b, signed=True))
+register_decoder('SGT', ['a', 'b'], compare_decoder(lambda a, b: a > b, signed=True))
+register_decoder('EQ', ['a', 'b'], compare_decoder(lambda a, b: a == b))
+register_decoder('ISZERO', ['a'], decode_iszero)
+# Старые версии geth называют KECCAK256 как SHA3
+register_decoder('KECCAK256', ['offset', 'size'], decode_keccak)
+register_decoder('SHA3', ['offset', 'size'], decode_keccak)
+register_decoder('CALLDATALOAD', ['offset'])
+register_decoder('CALLDATASIZE', [])
+register_decoder('RETURNDATACOPY', ['dest_offset', 'offset', 'size'])
+register_decoder('MSTORE', ['offset', 'value'])
+register_decoder('MSTORE8', ['offset', 'value'])
+register_decoder('SLOAD', ['key'])
+register_decoder('SSTORE', ['key', 'value'])
+register_decoder('JUMP', ['destination'])
+register_decoder('JUMPI', ['counter', 'condition'])
+for topics in range(5):
+    register_decoder(f'LOG{topics}', ['offset', 'size'] + [f'topic{i}' for i in range(topics)], log_decoder(topics))
+register_decoder('CREATE', ['value', 'offset', 'size'])
+register_decoder('CREATE2', ['value', 'offset', 'size', 'salt'])
+register_decoder('CALL', ['gas', 'to', 'value', 'in_offset', 'in_size'], decode_call)
+register_decoder('CALLCODE', ['gas', 'to', 'value', 'in_offset', 'in_size'], decode_call)
+register_decoder('DELEGATECALL', ['gas', 'to', 'in_offset', 'in_size'], decode_call)
+register_decoder('STATICCALL', ['gas', 'to', 'in_offset', 'in_size'], decode_call)
+register_decoder('RETURN', ['offset', 'size'])
+register_decoder('REVERT', ['offset', 'size'], decode_revert)
+register_decoder('SELFDESTRUCT', ['beneficiary'], decode_selfdestruct)
+
+def process_struct_logs(struct_logs, decoders=None, state=None):
+    """
+    Декодирует шаги structLog опкодов из таблицы decoders (по умолчанию DECODERS).
+    Остальные шаги отбрасываются. Для трейса без memory нужен state (TraceState),
+    который восстанавливает memory по шагам.
+    """
+    decoders = DECODERS if decoders is None else decoders
     results = []
+    sload = None
     for log in struct_logs:
+        if state is not None:
+            memory = state.step(log)
+        if sload is not None:
+            # Загруженное значение лежит на верху стека следующего шага того же фрейма
+            stack = log.get('stack')
+            if stack and log.get('depth', 0) == sload['depth']:
+                sload['result'] = stack[-1]
+            sload = None
         op = log.get('op')
-        if op in OPCODES:
-            result = {
-                'op': op,
-                'args': {},
-                'pc': log.get('pc', 0),
-                'depth': log.get('depth', 0),
-                'result': '',
-            }
-            result['gas'] = log.get('gas', 0)
-            result['gasCost'] = log.get('gasCost', 0)
-            if 'stack' in log:
-                stack = log['stack']
-                args = OPCODES[op]['args']
-                
-                # Обрабатываем все опкоды
-                if op in ['CALL', 'DELEGATECALL', 'STATICCALL', 'CALLCODE']:
-                    # Стек для CALL: [retSize, retOffset, argsSize, argsOffset, value, address, gas]
-                    # Для DELEGATECALL/STATICCALL/CALLCODE: [retSize, retOffset, argsSize, argsOffset, address, gas]
-                    if op == 'CALL':
-                        result['args']['gas'] = stack[-1]
-                        result['args']['to'] = "0x" + stack[-2][2:].zfill(40)
-                        result['args']['value'] = stack[-3]
-                        result['args']['in_offset'] = stack[-4]
-                        result['args']['in_size'] = stack[-5]
-                        result['args']['ret_offset'] = stack[-6]
-                        result['args']['ret_size'] = stack[-7]
-                    else:
-                        result['args']['gas'] = stack[-1]
-                        result['args']['to'] = "0x" + stack[-2][2:].zfill(40)
-                        result['args']['in_offset'] = stack[-3]
-                        result['args']['in_size'] = stack[-4]
-                        result['args']['ret_offset'] = stack[-5]
-                        result['args']['ret_size'] = stack[-6]
-                    result['args']['input_data'] = get_memory_data(log.get('memory', []), result['args']['in_offset'], result['args']['in_size'])
-                
-                elif op == 'REVERT':
-                    offset = hex_to_int(stack[-1])  # Первый элемент стека
-                    size = hex_to_int(stack[-2])    # Второй элемент стека
-                    hex_full = get_memory_data(log.get('memory', []), offset, size)
-                    result['message_hex'] = hex_full
-                    result['message'] = hex_to_utf8(hex_full)
-                    result['args']['offset'] = stack[-1]
-                    result['args']['size'] = stack[-2]
-                
-                else:
-                    # Для всех остальных опкодов берем аргументы в правильном порядке
-                    # В стеке аргументы лежат в обратном порядке: [b, a]
-                    for i, arg in enumerate(args):
-                        if i < len(stack):
-                            result['args'][arg] = stack[-(i+1)]
-                    
-                    # Вычисляем результат для логических операций
-                    if op == 'GT':
-                        result['result'] = hex_to_int(result['args']['a']) > hex_to_int(result['args']['b'])
-                    elif op == 'LT':
-                        result['result'] = hex_to_int(result['args']['a']) < hex_to_int(result['args']['b'])
-                    elif op == 'EQ':
-                        result['result'] = hex_to_int(result['args']['a']) == hex_to_int(result['args']['b'])
-                    elif op == 'ISZERO':
-                        result['result'] = hex_to_int(result['args']['a']) == 0
-            results.append(result)
+        decode = decoders.get(op)
+        if decode is None:
+            continue
+        result = {
+            'op': op,
+            'args': {},
+            'pc': log.get('pc', 0),
+            'depth': log.get('depth', 0),
+            'result': '',
+            'gas': log.get('gas', 0),
+            'gasCost': log.get('gasCost', 0),
+        }
+        stack = log.get('stack')
+        if stack is not None:
+            if state is None:
+                memory = log.get('memory', [])
+            try:
+                decode(log, stack, memory, result)
+            except IndexError:
+                # Шаг с переполнением стека вниз: оставляем только pc и газ
+                pass
+        if op == 'SLOAD':
+            sload = result
+        results.append(result)
     return results
 
-def process_trace(tx_hash):
+def process_trace(tx_hash, output_path='cleaned_trace.json'):
     """
-    Обрабатывает трейс транзакции и возвращает результаты
+    Обрабатывает трейс транзакции и возвращает результаты.
+    Если output_path равен None, результат не сохраняется в файл.
     """
     # Получаем данные транзакции
     tx_data = get_transaction(tx_hash)
@@ -206,7 +375,12 @@ def process_trace(tx_hash):
         
     # Обрабатываем трейс
     struct_logs = trace_data['result']['structLogs']
-    results = process_struct_logs(struct_logs)
+    state = make_trace_state(tx['input'], tx['to'], tx.get('blockNumber') or 'latest')
+    with metrics.span('process_struct_logs') as span:
+        results = process_struct_logs(struct_logs, state=state)
+        span['steps'] = len(results)
+    if state is not None and state.approximate:
+        print("Warning: some memory could not be reconstructed from a stack-only trace")
     
     # Добавляем первый CALL из транзакции в начало трейса
     first_call = {
@@ -224,11 +398,16 @@ def process_trace(tx_hash):
     }
     results.insert(0, first_call)
     
+    if output_path is None:
+        return results
+    
     # Сохраняем результаты в cleaned_trace.json
-    with open('cleaned_trace.json', 'w') as f:
-        json.dump(results, f, indent=2)
+    with metrics.span('json.write') as span:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2)
+            span['bytes_out'] = f.tell()
         
-    print(f"Trace saved to cleaned_trace.json")
+    print(f"Trace saved to {output_path}")
     return results
 
 def main():
@@ -237,6 +416,7 @@ def main():
         print("Usage: python3 process_traces.py <tx_hash>")
         sys.exit(1)
         
+    metrics.report_startup()
     tx_hash = sys.argv[1]
     print(f"Processing transaction: {tx_hash}")
     
@@ -0,0 +1,47 @@
+import time
+import asyncio
+import threading
+
+class TokenBucket:
+    """
+    Token bucket: не больше rate операций в секунду в среднем и не больше burst подряд.
+    Потокобезопасен, подходит и для потоков, и для asyncio.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1.0):
+        """Забирает токены и возвращает, сколько секунд нужно подождать до их появления"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def try_acquire(self, tokens=1.0):
+        """Забирает токены, только если они есть прямо сейчас"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1.0):
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens=1.0):
+        delay = self.reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
@@ -0,0 +1,49 @@
+import json
+import os
+import hashlib
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Если задан RECORD_DIR, все ответы ноды, /verify и LLM сохраняются в кассету
+RECORD_DIR = os.getenv('RECORD_DIR')
+if RECORD_DIR:
+    RECORD_DIR = os.path.join(BASE_DIR, RECORD_DIR)
+
+# Виды записей в кассете
+KINDS = ('rpc', 'verify', 'llm')
+
+def make_key(kind, request):
+    """Строит стабильный ключ записи по виду и телу запроса"""
+    if kind == 'rpc':
+        # id запроса не влияет на ответ ноды
+        request = {'method': request.get('method'), 'params': request.get('params', [])}
+    payload = json.dumps(request, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(f"{kind}:{payload}".encode()).hexdigest()
+
+def record(kind, request, response):
+    """Сохраняет пару запрос/ответ в кассету, если включена запись"""
+    if not RECORD_DIR:
+        return
+    try:
+        kind_dir = os.path.join(RECORD_DIR, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        path = os.path.join(kind_dir, make_key(kind, request) + '.json')
+        with open(path, 'w') as f:
+            json.dump({'kind': kind, 'request': request, 'response': response}, f)
+    except Exception as e:
+        print(f"Error recording {kind} response: {e}")
+
+def load_cassette(cassette_dir):
+    """Загружает все записи кассеты в словарь {(kind, key): response}"""
+    entries = {}
+    for kind in KINDS:
+        kind_dir = os.path.join(cassette_dir, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for name in os.listdir(kind_dir):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(kind_dir, name), 'r') as f:
+                entry = json.load(f)
+            entries[(kind, make_key(kind, entry['request']))] = entry['response']
+    return entries
@@ -0,0 +1,174 @@
+import json
+import sys
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from recorder import load_cassette, make_key
+
+# Ответ модели для промптов, которых нет в кассете
+FALLBACK_ANALYSIS = """1. Summary of the issue
+Replayed analysis: no recording matched this prompt.
+
+2. Detailed analysis of the trace
+Not available in replay mode.
+
+3. Root cause
+Not available in replay mode.
+
+4. Recommendations
+Record this transaction with RECORD_DIR set to replay the real analysis."""
+
+def parse_latency(spec):
+    """Разбирает строку вида rpc=0.2,verify=0.1,llm=2 в словарь значений по видам запросов"""
+    latency = {'rpc': 0.0, 'verify': 0.0, 'llm': 0.0}
+    if not spec:
+        return latency
+    for part in spec.split(','):
+        kind, value = part.split('=')
+        latency[kind.strip()] = float(value)
+    return latency
+
+class ReplayState:
+    """Кассета и настройки задержек и ошибок, общие для всех потоков сервера"""
+    def __init__(self, entries, latency, jitter, strict, error_rate=None):
+        self.entries = entries
+        self.latency = latency
+        self.jitter = jitter
+        self.strict = strict
+        self.error_rate = error_rate or {}
+        self.lock = threading.Lock()
+        self.hits = {'rpc': 0, 'verify': 0, 'llm': 0}
+        self.misses = {'rpc': 0, 'verify': 0, 'llm': 0}
+        self.failures = {'rpc': 0, 'verify': 0, 'llm': 0}
+
+    def lookup(self, kind, request):
+        response = self.entries.get((kind, make_key(kind, request)))
+        with self.lock:
+            if response is None:
+                self.misses[kind] += 1
+            else:
+                self.hits[kind] += 1
+        return response
+
+    def delay(self, kind):
+        base = self.latency.get(kind, 0.0)
+        if base:
+            time.sleep(base * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self, kind):
+        """Решает, ответить ли на запрос ошибкой 503 (доля задаётся --error-rate)"""
+        if random.random() >= self.error_rate.get(kind, 0.0):
+            return False
+        with self.lock:
+            self.failures[kind] += 1
+        return True
+
+def make_handler(state):
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, {'hits': state.hits, 'misses': state.misses, 'failures': state.failures})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b'{}')
+            except json.JSONDecodeError:
+                self.send_json(400, {'error': 'Invalid JSON'})
+                return
+
+            kind = {'/verify': 'verify', '/llm': 'llm'}.get(self.path, 'rpc')
+            if state.should_fail(kind):
+                state.delay(kind)
+                self.send_json(503, {'error': 'Injected failure'})
+            elif self.path == '/verify':
+                self.handle_verify(payload)
+            elif self.path == '/llm':
+                self.handle_llm(payload)
+            else:
+                self.handle_rpc(payload)
+
+        def handle_rpc(self, payload):
+            state.delay('rpc')
+            # Поддерживаем и одиночные, и batch JSON-RPC запросы
+            requests_list = payload if isinstance(payload, list) else [payload]
+            replies = []
+            for request in requests_list:
+                response = state.lookup('rpc', request)
+                if response is None:
+                    reply = {
+                        'jsonrpc': '2.0',
+                        'id': request.get('id'),
+                        'error': {'code': -32000, 'message': f"No recording for {request.get('method')}"}
+                    }
+                else:
+                    reply = dict(response)
+                    reply['id'] = request.get('id')
+                replies.append(reply)
+            self.send_json(200, replies if isinstance(payload, list) else replies[0])
+
+        def handle_verify(self, payload):
+            state.delay('verify')
+            response = state.lookup('verify', {'address': payload.get('address')})
+            if response is None:
+                self.send_json(404, {'error': 'No recording for address'})
+            else:
+                self.send_json(200, response)
+
+        def handle_llm(self, payload):
+            state.delay('llm')
+            response = state.lookup('llm', {'model': payload.get('model'), 'prompt': payload.get('prompt')})
+            if response is None:
+                if state.strict:
+                    self.send_json(404, {'error': 'No recording for prompt'})
+                    return
+                response = {'text': FALLBACK_ANALYSIS}
+            self.send_json(200, response)
+
+    return ReplayHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves recorded node, /verify and LLM responses locally')
+    parser.add_argument('cassette', help='Directory written with RECORD_DIR')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--latency', default='', help='Injected latency in seconds, e.g. rpc=0.2,verify=0.1,llm=2')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Relative latency jitter, e.g. 0.1 for +-10%%')
+    parser.add_argument('--error-rate', default='', help='Share of requests answered with 503, e.g. llm=0.2')
+    parser.add_argument('--strict', action='store_true', help='Fail LLM prompts that are not in the cassette')
+    args = parser.parse_args()
+
+    entries = load_cassette(args.cassette)
+    if not entries:
+        print(f"Error: no recordings found in {args.cassette}")
+        sys.exit(1)
+
+    state = ReplayState(entries, parse_latency(args.latency), args.jitter, args.strict, parse_latency(args.error_rate))
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    base = f"http://{args.host}:{args.port}"
+    print(f"Replaying {len(entries)} recordings on {base}")
+    print(f"  NODE_URL={base}/ VERIFY_URL={base}/verify LLM_URL={base}/llm")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+import metrics
+
+CACHE_REQUESTS = metrics.REGISTRY.counter(
+    'revert_result_cache_requests_total', 'Result cache lookups by outcome', ['result'])
+
+def make_key(tx_hash, model, prompt_version):
+    """Ключ кэша: хэш транзакции, модель и версия промпта"""
+    raw = f"{tx_hash.lower()}:{model}:{prompt_version}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+class ResultCache:
+    """
+    Кэш готовых анализов: LRU в памяти и необязательный уровень на диске.
+    Одновременные запросы одного ключа ждут одну и ту же задачу.
+    """
+    def __init__(self, max_entries=512, disk_dir=None, ttl=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def is_expired(self, value):
+        return self.ttl is not None and time.time() - value.get('cachedAt', 0) > self.ttl
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.json')
+
+    def get(self, key):
+        """Возвращает результат из памяти или с диска"""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                if not self.is_expired(value):
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self.disk_path(key), 'r') as f:
+                value = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if self.is_expired(value):
+            return None
+        self.remember(key, value)
+        return value
+
+    def remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, key, value):
+        """Сохраняет результат в память и на диск"""
+        value = dict(value, cachedAt=time.time())
+        self.remember(key, value)
+        if self.disk_dir:
+            # Пишем через временный файл, чтобы не оставить обрезанный JSON
+            tmp_path = self.disk_path(key) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self.disk_path(key))
+        return value
+
+    async def get_or_run(self, key, factory):
+        """
+        Возвращает (результат, источник), где источник - 'hit', 'inflight' или 'miss'.
+        factory вызывается только если результата нет в кэше и он ещё не считается.
+        None от factory не кэшируется.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            CACHE_REQUESTS.inc(result='hit')
+            return cached, 'hit'
+
+        future = self.inflight.get(key)
+        if future is not None:
+            CACHE_REQUESTS.inc(result='inflight')
+            return await asyncio.shield(future), 'inflight'
+
+        CACHE_REQUESTS.inc(result='miss')
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            result = await factory()
+            if result is not None:
+                result = self.put(key, result)
+            future.set_result(result)
+            return result, 'miss'
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, не даём asyncio ругаться на непрочитанный future
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
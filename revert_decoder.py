@@ -0,0 +1,46 @@
+from eth_abi import decode
+
+ERROR_SELECTOR = '0x08c379a0'  # Error(string)
+PANIC_SELECTOR = '0x4e487b71'  # Panic(uint256)
+
+PANIC_CODES = {
+    0x00: 'generic compiler panic',
+    0x01: 'assert failed',
+    0x11: 'arithmetic overflow or underflow',
+    0x12: 'division or modulo by zero',
+    0x21: 'invalid enum value',
+    0x22: 'invalid storage byte array encoding',
+    0x31: 'pop on empty array',
+    0x32: 'array index out of bounds',
+    0x41: 'out of memory',
+    0x51: 'call to zero-initialized function pointer',
+}
+
+def decode_revert_data(message_hex):
+    """Декодирует данные реверта: Error(string), Panic(uint256) или кастомную ошибку"""
+    if not message_hex or message_hex == '0x':
+        return {'type': 'empty'}
+    selector = message_hex[:10].lower()
+    try:
+        data = bytes.fromhex(message_hex[10:])
+        if selector == ERROR_SELECTOR:
+            return {'type': 'error', 'reason': decode(['string'], data)[0]}
+        if selector == PANIC_SELECTOR:
+            code = decode(['uint256'], data)[0]
+            return {'type': 'panic', 'code': code, 'reason': PANIC_CODES.get(code, 'unknown panic')}
+    except Exception:
+        pass
+    return {'type': 'custom', 'selector': selector}
+
+def get_revert_data(trace):
+    """Возвращает pc и декодированные данные последнего REVERT в трейсе"""
+    for op in reversed(trace):
+        if op['op'] == 'REVERT':
+            revert = {
+                'pc': op.get('pc'),
+                'depth': op.get('depth'),
+                'message_hex': op.get('message_hex', '0x'),
+            }
+            revert.update(decode_revert_data(revert['message_hex']))
+            return revert
+    return None
@@ -8,6 +8,20 @@ from datetime import datetime
 import logging
 import requests
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import uuid
+import metrics
+import result_cache
+import fingerprint
+from source_map import apply_source_map
+import block_scanner
+import analysis_store
+import job_events
+from analyze_revert import MODEL_NAME, PROMPT_VERSION, ANALYSIS_ERROR_PREFIX, get_revert_info, run_analysis
+from emulate_trace import get_block_number, build_variant, summarize_call, trace_variant
+from revert_decoder import get_revert_data
+from llm_scheduler import SCHEDULER, LLM_DEADLINE, DeadlineExceeded
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,6 +34,51 @@ logger = logging.getLogger(__name__)
 # Глобальная переменная для хранения активных подключений
 connected_clients = set()
 
+# Клиенты, которым сейчас повторяются события по resume: рассылка копит для них сообщения,
+# пока повтор не закончится, чтобы живые события не обогнали повторяемые
+replaying = {}
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Каждая задача работает в своей директории, чтобы параллельные задачи не затирали файлы друг друга
+JOBS_DIR = os.getenv('JOBS_DIR', os.path.join(BASE_DIR, 'jobs'))
+KEEP_JOB_DIRS = os.getenv('KEEP_JOB_DIRS') == '1'
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8766'))
+
+# Кэш готовых анализов по хэшу транзакции; RESULT_CACHE_DIR включает уровень на диске
+RESULT_CACHE = result_cache.ResultCache(
+    max_entries=int(os.getenv('RESULT_CACHE_SIZE', '512')),
+    disk_dir=os.getenv('RESULT_CACHE_DIR'),
+    ttl=float(os.getenv('RESULT_CACHE_TTL')) if os.getenv('RESULT_CACHE_TTL') else None
+)
+
+# История задач в SQLite; пустой ANALYSIS_DB отключает её
+STORE = analysis_store.AnalysisStore() if analysis_store.ANALYSIS_DB else None
+
+# Задачи и их логи событий для resume
+JOBS = job_events.JobRegistry()
+
+# Параметры сканера блоков: параллелизм по умолчанию, его предел и лимит новых транзакций в секунду
+SCAN_CONCURRENCY = int(os.getenv('SCAN_CONCURRENCY', '4'))
+SCAN_MAX_CONCURRENCY = int(os.getenv('SCAN_MAX_CONCURRENCY', '16'))
+SCAN_RATE = float(os.getenv('SCAN_RATE')) if os.getenv('SCAN_RATE') else None
+
+# Ограничения пакетной эмуляции: число вариантов в запросе и одновременных debug_traceCall
+MAX_EMULATE_VARIANTS = int(os.getenv('MAX_EMULATE_VARIANTS', '100'))
+EMULATE_BATCH_CONCURRENCY = int(os.getenv('EMULATE_BATCH_CONCURRENCY', '8'))
+
+def make_job_dir():
+    """Создаёт рабочую директорию для новой задачи"""
+    job_dir = os.path.join(JOBS_DIR, uuid.uuid4().hex)
+    os.makedirs(job_dir, exist_ok=True)
+    return job_dir
+
+def remove_job_dir(job_dir):
+    """Удаляет рабочую директорию задачи"""
+    if not KEEP_JOB_DIRS:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
 async def register(websocket):
     """Регистрирует новое подключение"""
     logger.info(f"Registering new connection. Total connections: {len(connected_clients)}")
@@ -35,10 +94,13 @@ async def register(websocket):
 async def broadcast(message):
     """Отправляет сообщение всем подключенным клиентам"""
     logger.info(f"Broadcasting message to {len(connected_clients)} clients: {message}")
-    if connected_clients:
+    for pending in replaying.values():
+        pending.append(message)
+    clients = [client for client in connected_clients if client not in replaying]
+    if clients:
         try:
             await asyncio.gather(
-                *[client.send(json.dumps(message)) for client in connected_clients]
+                *[client.send(json.dumps(message)) for client in clients]
             )
             logger.info("Message broadcasted successfully")
         except Exception as e:
@@ -46,6 +108,64 @@ async def broadcast(message):
     else:
         logger.warning("No connected clients to broadcast to")
 
+def start_job(kind, tx_hash=None):
+    """Регистрирует задачу; первое событие сообщает клиентам её jobId"""
+    job = JOBS.create(kind, tx_hash)
+    logger.info(f"Job {job.id} ({kind}) started")
+    return job
+
+async def publish(job, message, replay=True):
+    """
+    Рассылает событие задачи. События с replay=True попадают в лог задачи с порядковым номером
+    и повторяются клиенту по resume; вывод скриптов только помечается jobId.
+    """
+    if job is None:
+        await broadcast(message)
+    elif replay:
+        await broadcast(job.record(message))
+    else:
+        await broadcast(dict(message, jobId=job.id))
+
+async def resume(websocket, data):
+    """Повторяет клиенту события задачи после afterSeq; дальше он получает события вместе со всеми"""
+    job = JOBS.get(job_id=data.get('jobId'), tx_hash=data.get('txHash'))
+    if job is None:
+        job_events.RESUMES.inc(result='unknown')
+        await websocket.send(json.dumps({
+            'type': 'error',
+            'action': 'resume',
+            'message': 'Unknown or expired job',
+            'timestamp': datetime.now().isoformat()
+        }))
+        return
+    try:
+        after = int(data.get('afterSeq') or 0)
+    except (TypeError, ValueError):
+        after = 0
+    # Снимок лога и начало буферизации происходят без await между ними, поэтому каждое событие
+    # попадает клиенту ровно один раз: либо из снимка, либо из буфера после него
+    events, truncated = job.events_after(after)
+    pending = replaying[websocket] = []
+    job_events.RESUMES.inc(result='truncated' if truncated else 'ok')
+    try:
+        await websocket.send(json.dumps({
+            'type': 'resume',
+            'jobId': job.id,
+            'kind': job.kind,
+            'txHash': job.tx_hash,
+            'lastSeq': job.seq,
+            'finished': job.finished,
+            'truncated': truncated
+        }))
+        for event in events:
+            await websocket.send(json.dumps(event))
+        # Пока отправляется буфер, в него могут прийти новые события; выходим, когда он пуст
+        while pending:
+            message = pending.pop(0)
+            await websocket.send(json.dumps(message))
+    finally:
+        del replaying[websocket]
+
 async def send_to_api(data):
     """Отправляет данные на API"""
     try:
@@ -67,52 +187,75 @@ async def send_to_api(data):
             'timestamp': datetime.now().isoformat()
         }
 
-async def run_script(script_name, tx_hash=None):
+def extract_metrics(text, timings=None):
+    """Забирает из вывода скрипта строки с метриками и возвращает остальной текст"""
+    lines = []
+    for line in text.split('\n'):
+        span = metrics.parse_line(line)
+        if span is None:
+            lines.append(line)
+        else:
+            metrics.observe(span, timings)
+    return '\n'.join(lines)
+
+async def run_script(script_name, tx_hash=None, cwd=None, timings=None, env=None, job=None):
     """Запускает скрипт с переданным хэшем транзакции"""
     try:
         # Формируем команду для запуска скрипта
-        cmd = ['python3', '-Xfrozen_modules=off', script_name]
+        cmd = ['python3', '-Xfrozen_modules=off', os.path.join(BASE_DIR, script_name)]
         if tx_hash:
             cmd.append(tx_hash)
             
         logger.info(f"Running command: {' '.join(cmd)}")
+        
+        # Дочерний процесс отправляет спаны через stdout
+        env = dict(os.environ, METRICS_PIPE='1', SPAWN_TS=str(time.time()), **(env or {}))
             
         # Запускаем процесс
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            env=env
         )
         
         # Читаем stdout и stderr в реальном времени
+        # Неполную последнюю строку stdout оставляем до следующего чтения, чтобы не разрезать метрики
+        stdout_pending = b''
         while True:
             stdout_data = await process.stdout.read(1024)
             stderr_data = await process.stderr.read(1024)
             
-            if not stdout_data and not stderr_data:
+            if not stdout_data and not stderr_data and not stdout_pending:
                 break
+            
+            if stdout_data:
+                stdout_data, _, stdout_pending = (stdout_pending + stdout_data).rpartition(b'\n')
+            else:
+                stdout_data, stdout_pending = stdout_pending, b''
                 
             if stdout_data:
-                message = stdout_data.decode().strip()
+                message = extract_metrics(stdout_data.decode(errors='replace'), timings).strip()
                 if message:
                     logger.info(f"STDOUT from {script_name}: {message}")
-                    await broadcast({
+                    await publish(job, {
                         'type': 'stdout',
                         'script': script_name,
                         'data': message,
                         'timestamp': datetime.now().isoformat()
-                    })
+                    }, replay=False)
                     
             if stderr_data:
                 message = stderr_data.decode().strip()
                 if message:
                     logger.error(f"STDERR from {script_name}: {message}")
-                    await broadcast({
+                    await publish(job, {
                         'type': 'stderr',
                         'script': script_name,
                         'data': message,
                         'timestamp': datetime.now().isoformat()
-                    })
+                    }, replay=False)
         
         # Ждем завершения процесса
         await process.wait()
@@ -128,262 +271,504 @@ async def run_script(script_name, tx_hash=None):
         logger.error(traceback.format_exc())
         return False
 
-async def process_scripts(tx_hash):
-    """Обрабатывает последовательное выполнение скриптов"""
-    logger.info(f"Starting script processing for tx_hash: {tx_hash}")
-    
-    # Stage 1: Fetching transaction traces
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Fetching transaction traces',
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    if not await run_script('process_traces.py', tx_hash):
-        return
-        
-    # Add delay between stages
-    await asyncio.sleep(1)
-    
-    # Stage 2: Cleaning trace
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Compiling sources',
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    if not await run_script('clean_trace.py', tx_hash):
-        return
-        
-    # Add delay between stages
-    await asyncio.sleep(1)
-    
-    # Stage 3: Fetching contract metadata
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Fetching contract metadata',
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    # Get contract address from cleaned_trace.json
+def attach_source_map(job_dir, timings=None):
+    """Добавляет в cleaned_trace.json исходный код из source map первого вызванного контракта"""
+    trace_path = os.path.join(job_dir, 'cleaned_trace.json')
     try:
-        with open('cleaned_trace.json', 'r') as f:
-            trace = json.load(f)
+        with metrics.span('json.read', timings=timings) as span:
+            with open(trace_path, 'r') as f:
+                trace = json.load(f)
+                span['bytes_in'] = f.tell()
             
-        # Find first CALL to get contract address
-        contract_address = None
-        for op in trace:
-            if op['op'] in ['CALL', 'DELEGATECALL', 'STATICCALL']:
-                contract_address = op['args']['to']
-                break
-                
+        contract_address = apply_source_map(trace, timings)
         if contract_address:
-            # Get source map for the contract
-            response = requests.post(
-                'http://205.196.81.76:5000/verify',
-                headers={'Content-Type': 'application/json'},
-                json={'address': contract_address},
-                timeout=10
-            )
-            response.raise_for_status()
-            source_map_list = response.json().get('jsonSourceMap', [])
-            source_map = {
-                item['pc']: {
-                    'code': item.get('code', '')[:256] if len(item.get('code', '')) < 256 else '',
-                    'context_code': item.get('context_code', '')[:512] if len(item.get('context_code', '')) < 512 else ''
-                } for item in source_map_list
-            }
-
-            source_code_filled = {}
-            current_source_code = {}
-
-            for idx in range(max(source_map.keys())):
-                if idx in source_map.keys():
-                    source_code_filled[idx] = source_map[idx]
-                    current_source_code = source_map[idx]
-                else:
-                    source_code_filled[idx] = current_source_code
-
-            for idx, op in enumerate(trace):
-                pc = op['pc']
-                if pc in source_code_filled.keys():
-                    trace[idx]['code'] = source_code_filled[pc]['code']
-                    trace[idx]['context_code'] = source_code_filled[pc]['context_code']
-                else:
-                    trace[idx]['code'] = ''
-                    trace[idx]['context_code'] = ''
-            
             # Save updated trace
-            with open('cleaned_trace.json', 'w') as f:
-                json.dump(trace, f, indent=2)
+            with metrics.span('json.write', timings=timings) as span:
+                with open(trace_path, 'w') as f:
+                    json.dump(trace, f, indent=2)
+                    span['bytes_out'] = f.tell()
                 
             logger.info(f"Source map collected and trace updated for contract: {contract_address}")
     except Exception as e:
         logger.error(f"Error collecting source map: {e}")
+
+def record_job(kind, status, tx_hash=None, trace=None, revert=None, fingerprint_info=None,
+               analysis=None, timings=None, duration=None, contract=None, selector=None):
+    """Ставит задачу в очередь записи истории"""
+    if STORE is None:
+        return
+    if trace is not None:
+        contract, selector = analysis_store.get_call_info(trace)
+    if timings is not None:
+        duration = time.perf_counter() - timings.started
+    STORE.add(analysis_store.make_job(
+        kind, status,
+        tx_hash=tx_hash,
+        contract=contract,
+        selector=selector,
+        revert=revert,
+        fingerprint=fingerprint_info,
+        model=MODEL_NAME if analysis else None,
+        prompt_version=PROMPT_VERSION if analysis else None,
+        duration=duration,
+        timings=timings.as_dict() if timings is not None else None,
+        analysis=analysis
+    ))
+
+def read_fingerprint(job_dir):
+    """Читает сведения об отпечатке реверта, которые оставил analyze_revert.py"""
+    try:
+        with open(os.path.join(job_dir, 'fingerprint.json'), 'r') as f:
+            info = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    info['hitRate'] = round(fingerprint.hit_rate(), 4)
+    return info
+
+async def timed_stage(name, timings, awaitable):
+    """Выполняет этап пайплайна и записывает его длительность"""
+    with metrics.span(name, kind='stage', timings=timings):
+        return await awaitable
+
+async def run_analysis_script(arg, job_dir, timings, job=None):
+    """
+    Запускает analyze_revert.py, заняв слот общего лимита запросов к модели.
+    Срок задачи передаётся скрипту, чтобы ожидание в очереди входило в него.
+    """
+    deadline = time.time() + LLM_DEADLINE
+    try:
+        await SCHEDULER.acquire_async(deadline)
+    except DeadlineExceeded as e:
+        await publish(job, {
+            'type': 'error',
+            'message': str(e),
+            'timestamp': datetime.now().isoformat()
+        })
+        return False
+    try:
+        return await run_script('analyze_revert.py', arg, cwd=job_dir, timings=timings,
+                                env={'LLM_DEADLINE_AT': str(deadline)}, job=job)
+    finally:
+        SCHEDULER.release()
+
+async def process_scripts(tx_hash, job):
+    """Обрабатывает последовательное выполнение скриптов и возвращает результат анализа"""
+    logger.info(f"Starting script processing for tx_hash: {tx_hash}")
+    job_dir = make_job_dir()
+    timings = metrics.JobTimings()
+    status = 'failed'
+    cleaned_trace = revert = revert_fingerprint = analysis = None
+    try:
+        # Stage 1: Fetching transaction traces
+        await publish(job, {
+            'type': 'stage',
+            'txHash': tx_hash,
+            'stage': 'Fetching transaction traces',
+            'timestamp': datetime.now().isoformat()
+        })
+    
+        if not await timed_stage('fetch_trace', timings, run_script('process_traces.py', tx_hash, cwd=job_dir, timings=timings, job=job)):
+            return
+        
+        # Add delay between stages
+        await asyncio.sleep(1)
+    
+        # Stage 2: Cleaning trace
+        await publish(job, {
+            'type': 'stage',
+            'txHash': tx_hash,
+            'stage': 'Compiling sources',
+            'timestamp': datetime.now().isoformat()
+        })
     
-    # Add delay between stages
-    await asyncio.sleep(1)
+        if not await timed_stage('clean_trace', timings, run_script('clean_trace.py', tx_hash, cwd=job_dir, timings=timings, job=job)):
+            return
+        
+        # Add delay between stages
+        await asyncio.sleep(1)
     
-    # Stage 4: Analyzing transaction with AI
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Analyzing transaction with AI',
-        'timestamp': datetime.now().isoformat()
-    })
+        # Stage 3: Fetching contract metadata
+        await publish(job, {
+            'type': 'stage',
+            'txHash': tx_hash,
+            'stage': 'Fetching contract metadata',
+            'timestamp': datetime.now().isoformat()
+        })
     
-    if not await run_script('analyze_revert.py', tx_hash):
-        return
+        await timed_stage('source_map', timings, asyncio.get_running_loop().run_in_executor(None, attach_source_map, job_dir, timings))
     
+        # Add delay between stages
+        await asyncio.sleep(1)
+    
+        # Stage 4: Analyzing transaction with AI
+        await publish(job, {
+            'type': 'stage',
+            'txHash': tx_hash,
+            'stage': 'Analyzing transaction with AI',
+            'timestamp': datetime.now().isoformat()
+        })
+    
+        if not await timed_stage('analysis', timings, run_analysis_script(tx_hash, job_dir, timings, job)):
+            return
+    
+        try:
+            # Read results from files
+            with open(os.path.join(job_dir, 'cleaned_trace.json'), 'r') as f:
+                cleaned_trace = json.load(f)
+            with open(os.path.join(job_dir, 'revert_analysis.txt'), 'r') as f:
+                analysis = f.read()
+            revert = get_revert_data(cleaned_trace)
+            revert_fingerprint = read_fingerprint(job_dir)
+        
+            # Send results through WebSocket
+            await publish(job, {
+                'type': 'complete',
+                'txHash': tx_hash,
+                'message': 'Analysis completed',
+                'data': analysis,
+                'revert': revert,
+                'fingerprint': revert_fingerprint,
+                'timings': timings.as_dict()
+            })
+            status = 'completed'
+
+            # Ошибку модели не кэшируем, чтобы следующий запрос повторил анализ
+            if not analysis.startswith(ANALYSIS_ERROR_PREFIX):
+                return {
+                    'txHash': tx_hash,
+                    'model': MODEL_NAME,
+                    'promptVersion': PROMPT_VERSION,
+                    'analysis': analysis,
+                    'revert': revert,
+                    'fingerprint': revert_fingerprint
+                }
+            
+        except Exception as e:
+            logger.error(f"Error processing results: {e}")
+            await publish(job, {
+                'type': 'error',
+                'message': f'Error processing results: {str(e)}',
+                'timestamp': datetime.now().isoformat()
+            })
+    finally:
+        metrics.JOBS.inc(kind='start', status=status)
+        metrics.JOB_SECONDS.observe(time.perf_counter() - timings.started, kind='start')
+        record_job('start', status, tx_hash, cleaned_trace, revert, revert_fingerprint, analysis, timings)
+        remove_job_dir(job_dir)
+
+async def analyze_transaction(tx_hash):
+    """Отдаёт анализ из кэша или запускает пайплайн; повторные запросы ждут уже идущую задачу"""
+    key = result_cache.make_key(tx_hash, MODEL_NAME, PROMPT_VERSION)
+    job = start_job('start', tx_hash)
     try:
-        # Read results from files
-        with open('cleaned_trace.json', 'r') as f:
-            cleaned_trace = json.load(f)
-        with open('revert_analysis.txt', 'r') as f:
-            analysis = f.read()
+        await publish(job, {'type': 'job', 'kind': job.kind, 'txHash': tx_hash})
+        result, source = await RESULT_CACHE.get_or_run(key, lambda: process_scripts(tx_hash, job))
+        logger.info(f"Analysis for {tx_hash} served from {source}")
         
-        # Send results through WebSocket
-        await broadcast({
+        complete = None if result is None else {
             'type': 'complete',
+            'txHash': tx_hash,
             'message': 'Analysis completed',
-            'data': analysis
+            'data': result['analysis'],
+            'revert': result['revert'],
+            'cached': True
+        }
+        if source == 'hit':
+            await publish(job, complete)
+        elif source == 'inflight' and complete:
+            # Событие complete уже разослано задачей, которая считала анализ; для resume сохраняем его в логе этой задачи
+            job.record(complete)
+        return result
+    finally:
+        JOBS.finish(job)
+
+async def process_scan(from_block, to_block, concurrency, analyze=True):
+    """Ищет и анализирует все неуспешные транзакции в диапазоне блоков"""
+    logger.info(f"Scanning blocks {from_block}-{to_block} with concurrency {concurrency}")
+    job = start_job('scan')
+    try:
+        await publish(job, {'type': 'job', 'kind': job.kind})
+        await publish(job, {
+            'type': 'stage',
+            'stage': 'Scanning blocks for failed transactions',
+            'timestamp': datetime.now().isoformat()
         })
-            
+        
+        try:
+            results, summary = await block_scanner.scan_blocks(
+                from_block, to_block, lambda message: publish(job, message),
+                concurrency=min(concurrency, SCAN_MAX_CONCURRENCY),
+                rate=SCAN_RATE,
+                analyze=analyze
+            )
+        except ValueError as e:
+            await publish(job, {
+                'type': 'error',
+                'message': str(e),
+                'timestamp': datetime.now().isoformat()
+            })
+            return
+    finally:
+        JOBS.finish(job)
+    
+    # Анализы сканера попадают в общий кэш, и последующий start по этим хэшам отвечает сразу
+    for result in results:
+        analysis = result.get('analysis')
+        record_job(
+            'scan', result['status'], result['txHash'],
+            revert=result.get('revert'),
+            fingerprint_info=result.get('fingerprint'),
+            analysis=analysis,
+            contract=result.get('contract'),
+            selector=result.get('selector')
+        )
+        if analysis and not analysis.startswith(ANALYSIS_ERROR_PREFIX):
+            RESULT_CACHE.put(result_cache.make_key(result['txHash'], MODEL_NAME, PROMPT_VERSION), {
+                'txHash': result['txHash'],
+                'model': MODEL_NAME,
+                'promptVersion': PROMPT_VERSION,
+                'analysis': analysis,
+                'revert': result['revert'],
+                'fingerprint': result.get('fingerprint')
+            })
+    logger.info(f"Scan finished: {summary}")
+
+def analyze_variant(params, block, state_overrides=None):
+    """Полный трейс и AI анализ одного варианта эмуляции"""
+    started = time.perf_counter()
+    cleaned_trace = trace_variant(params, block, state_overrides)
+    if not cleaned_trace:
+        return None
+    try:
+        apply_source_map(cleaned_trace)
     except Exception as e:
-        logger.error(f"Error processing results: {e}")
-        await broadcast({
-            'type': 'error',
-            'message': f'Error processing results: {str(e)}',
+        logger.error(f"Error collecting source map: {e}")
+    revert_info = get_revert_info(cleaned_trace)
+    if not revert_info:
+        return None
+    analysis, fingerprint_info = run_analysis('emulation', revert_info, prompt_path=None)
+    revert = get_revert_data(cleaned_trace)
+    record_job(
+        'emulate_batch', 'completed' if analysis else 'failed', None, cleaned_trace, revert,
+        fingerprint_info, analysis, duration=time.perf_counter() - started
+    )
+    return {
+        'analysis': analysis,
+        'revert': revert,
+        'fingerprint': fingerprint_info
+    }
+
+async def process_emulate_batch(base, variants, block=None, state_overrides=None, analyze=()):
+    """
+    Эмулирует варианты вызова на одном зафиксированном блоке и рассылает сводку по каждому.
+    AI анализ запускается только для вариантов из analyze.
+    """
+    logger.info(f"Starting batch emulation of {len(variants)} variants")
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    job = start_job('emulate_batch')
+    
+    def variant_call(variant):
+        overrides = dict(state_overrides or {})
+        overrides.update(variant.get('stateOverrides') or {})
+        return build_variant(base, variant), overrides or None
+    
+    executor = ThreadPoolExecutor(max_workers=EMULATE_BATCH_CONCURRENCY, thread_name_prefix='emulate')
+    try:
+        await publish(job, {'type': 'job', 'kind': job.kind})
+        await publish(job, {
+            'type': 'stage',
+            'stage': 'Emulating variants',
             'timestamp': datetime.now().isoformat()
         })
+        
+        # Все варианты выполняются на одном блоке, чтобы результаты были сравнимы
+        if block is None:
+            block = await loop.run_in_executor(None, get_block_number)
+            if not block:
+                await publish(job, {
+                    'type': 'error',
+                    'message': 'Could not get current block number',
+                    'timestamp': datetime.now().isoformat()
+                })
+                return
+        
+        async def run_variant(index, variant):
+            params, overrides = variant_call(variant)
+            summary = await loop.run_in_executor(executor, summarize_call, params, block, overrides)
+            summary['index'] = index
+            await publish(job, {'type': 'emulate_batch_result', 'block': block, 'result': summary})
+            return summary
+        
+        summaries = await asyncio.gather(*[run_variant(i, variant) for i, variant in enumerate(variants)])
+        await publish(job, {
+            'type': 'emulate_batch_complete',
+            'block': block,
+            'results': summaries,
+            'elapsed': round(time.perf_counter() - started, 3)
+        })
+        
+        for index in analyze:
+            if not 0 <= index < len(variants):
+                continue
+            await publish(job, {
+                'type': 'stage',
+                'stage': f'Analyzing variant {index} with AI',
+                'timestamp': datetime.now().isoformat()
+            })
+            params, overrides = variant_call(variants[index])
+            result = await loop.run_in_executor(executor, analyze_variant, params, block, overrides)
+            if result is None:
+                await publish(job, {
+                    'type': 'error',
+                    'variant': index,
+                    'message': 'Variant did not revert, nothing to analyze',
+                    'timestamp': datetime.now().isoformat()
+                })
+                continue
+            await publish(job, {
+                'type': 'complete',
+                'variant': index,
+                'block': block,
+                'message': 'Analysis completed',
+                'data': result['analysis'],
+                'revert': result['revert'],
+                'fingerprint': result['fingerprint']
+            })
+    finally:
+        executor.shutdown(wait=False)
+        JOBS.finish(job)
 
 async def process_emulation(params):
     """Обрабатывает эмуляцию транзакции"""
     logger.info(f"Starting emulation processing with params: {params}")
+    job_dir = make_job_dir()
+    timings = metrics.JobTimings()
+    status = 'failed'
+    cleaned_trace = revert = revert_fingerprint = analysis = None
+    job = start_job('emulate')
+    try:
+        await publish(job, {'type': 'job', 'kind': job.kind})
+        
+        # Stage 1: Emulating transaction
+        await publish(job, {
+            'type': 'stage',
+            'stage': 'Emulating transaction',
+            'timestamp': datetime.now().isoformat()
+        })
     
-    # Stage 1: Emulating transaction
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Emulating transaction',
-        'timestamp': datetime.now().isoformat()
-    })
-    
-    # Запускаем скрипт эмуляции
-    if not await run_script('emulate_trace.py', json.dumps(params)):
-        return
+        # Запускаем скрипт эмуляции
+        if not await timed_stage('emulate_trace', timings, run_script('emulate_trace.py', json.dumps(params), cwd=job_dir, timings=timings, job=job)):
+            return
         
-    # Add delay between stages
-    await asyncio.sleep(1)
+        # Add delay between stages
+        await asyncio.sleep(1)
     
-    # Stage 2: Cleaning trace
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Compiling sources',
-        'timestamp': datetime.now().isoformat()
-    })
+        # Stage 2: Cleaning trace
+        await publish(job, {
+            'type': 'stage',
+            'stage': 'Compiling sources',
+            'timestamp': datetime.now().isoformat()
+        })
     
-    if not await run_script('clean_trace.py', 'emulate'):
-        return
+        if not await timed_stage('clean_trace', timings, run_script('clean_trace.py', 'emulate', cwd=job_dir, timings=timings, job=job)):
+            return
         
-    # Add delay between stages
-    await asyncio.sleep(1)
+        # Add delay between stages
+        await asyncio.sleep(1)
     
-    # Stage 3: Fetching contract metadata
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Fetching contract metadata',
-        'timestamp': datetime.now().isoformat()
-    })
+        # Stage 3: Fetching contract metadata
+        await publish(job, {
+            'type': 'stage',
+            'stage': 'Fetching contract metadata',
+            'timestamp': datetime.now().isoformat()
+        })
     
-    # Get contract address from cleaned_trace.json
-    try:
-        with open('cleaned_trace.json', 'r') as f:
-            trace = json.load(f)
-            
-        # Find first CALL to get contract address
-        contract_address = None
-        for op in trace:
-            if op['op'] in ['CALL', 'DELEGATECALL', 'STATICCALL']:
-                contract_address = op['args']['to']
-                break
-                
-        if contract_address:
-            # Get source map for the contract
-            response = requests.post(
-                'http://205.196.81.76:5000/verify',
-                headers={'Content-Type': 'application/json'},
-                json={'address': contract_address},
-                timeout=10
-            )
-            response.raise_for_status()
-            source_map_list = response.json().get('jsonSourceMap', [])
-            source_map = {
-                item['pc']: {
-                    'code': item.get('code', '')[:256] if len(item.get('code', '')) < 256 else '',
-                    'context_code': item.get('context_code', '')[:512] if len(item.get('context_code', '')) < 512 else ''
-                } for item in source_map_list
-            }
-
-            source_code_filled = {}
-            current_source_code = {}
-
-            for idx in range(max(source_map.keys())):
-                if idx in source_map.keys():
-                    source_code_filled[idx] = source_map[idx]
-                    current_source_code = source_map[idx]
-                else:
-                    source_code_filled[idx] = current_source_code
-
-            for idx, op in enumerate(trace):
-                pc = op['pc']
-                if pc in source_code_filled.keys():
-                    trace[idx]['code'] = source_code_filled[pc]['code']
-                    trace[idx]['context_code'] = source_code_filled[pc]['context_code']
-                else:
-                    trace[idx]['code'] = ''
-                    trace[idx]['context_code'] = ''
-            
-            # Save updated trace
-            with open('cleaned_trace.json', 'w') as f:
-                json.dump(trace, f, indent=2)
-                
-            logger.info(f"Source map collected and trace updated for contract: {contract_address}")
-    except Exception as e:
-        logger.error(f"Error collecting source map: {e}")
+        await timed_stage('source_map', timings, asyncio.get_running_loop().run_in_executor(None, attach_source_map, job_dir, timings))
     
-    # Add delay between stages
-    await asyncio.sleep(1)
+        # Add delay between stages
+        await asyncio.sleep(1)
     
-    # Stage 4: Analyzing transaction with AI
-    await broadcast({
-        'type': 'stage',
-        'stage': 'Analyzing transaction with AI',
-        'timestamp': datetime.now().isoformat()
-    })
+        # Stage 4: Analyzing transaction with AI
+        await publish(job, {
+            'type': 'stage',
+            'stage': 'Analyzing transaction with AI',
+            'timestamp': datetime.now().isoformat()
+        })
     
-    if not await run_script('analyze_revert.py', 'emulate'):
-        return
+        if not await timed_stage('analysis', timings, run_analysis_script('emulate', job_dir, timings, job)):
+            return
     
-    try:
-        # Read results from files
-        with open('cleaned_trace.json', 'r') as f:
-            cleaned_trace = json.load(f)
-        with open('revert_analysis.txt', 'r') as f:
-            analysis = f.read()
+        try:
+            # Read results from files
+            with open(os.path.join(job_dir, 'cleaned_trace.json'), 'r') as f:
+                cleaned_trace = json.load(f)
+            with open(os.path.join(job_dir, 'revert_analysis.txt'), 'r') as f:
+                analysis = f.read()
+            revert = get_revert_data(cleaned_trace)
+            revert_fingerprint = read_fingerprint(job_dir)
         
-        # Send results through WebSocket
-        await broadcast({
-            'type': 'complete',
-            'message': 'Analysis completed',
-            'data': analysis
-        })
+            # Send results through WebSocket
+            await publish(job, {
+                'type': 'complete',
+                'message': 'Analysis completed',
+                'data': analysis,
+                'revert': revert,
+                'fingerprint': revert_fingerprint,
+                'timings': timings.as_dict()
+            })
+            status = 'completed'
+
             
-    except Exception as e:
-        logger.error(f"Error processing results: {e}")
-        await broadcast({
-            'type': 'error',
-            'message': f'Error processing results: {str(e)}',
-            'timestamp': datetime.now().isoformat()
-        })
+        except Exception as e:
+            logger.error(f"Error processing results: {e}")
+            await publish(job, {
+                'type': 'error',
+                'message': f'Error processing results: {str(e)}',
+                'timestamp': datetime.now().isoformat()
+            })
+    finally:
+        metrics.JOBS.inc(kind='emulate', status=status)
+        metrics.JOB_SECONDS.observe(time.perf_counter() - timings.started, kind='emulate')
+        if cleaned_trace is None:
+            # Трейс не получен: контракт и селектор известны из параметров эмуляции
+            record_job('emulate', status, timings=timings, contract=params.get('to'), selector=(params.get('data') or '')[:10])
+        else:
+            record_job('emulate', status, None, cleaned_trace, revert, revert_fingerprint, analysis, timings)
+        remove_job_dir(job_dir)
+        JOBS.finish(job)
+
+async def query_store(data):
+    """Выполняет запрос истории (history или top_reverting) и возвращает ответ клиенту"""
+    action = data.get('action')
+    if STORE is None:
+        return {'type': 'error', 'action': action, 'message': 'Analysis history is disabled',
+                'timestamp': datetime.now().isoformat()}
+    loop = asyncio.get_running_loop()
+    try:
+        if action == 'history':
+            items, next_cursor = await loop.run_in_executor(
+                None, lambda: STORE.history(
+                    filters=data,
+                    limit=data.get('limit', 20),
+                    cursor=data.get('cursor'),
+                    since=data.get('since'),
+                    until=data.get('until'),
+                    include_analysis=bool(data.get('includeAnalysis'))
+                )
+            )
+            return {'type': 'history', 'items': items, 'nextCursor': next_cursor}
+        contracts = await loop.run_in_executor(
+            None, lambda: STORE.top_reverting(
+                since=data.get('since'),
+                limit=data.get('limit', 20),
+                offset=data.get('offset', 0)
+            )
+        )
+        return {'type': 'top_reverting', 'contracts': contracts}
+    except (TypeError, ValueError) as e:
+        return {'type': 'error', 'action': action, 'message': f'Invalid {action} query: {e}',
+                'timestamp': datetime.now().isoformat()}
 
 async def handler(websocket):
     """WebSocket connection handler"""
@@ -414,7 +799,7 @@ async def handler(websocket):
                     
                     logger.info("Starting script processing...")
                     try:
-                        await process_scripts(tx_hash)
+                        await analyze_transaction(tx_hash)
                         logger.info("Script processing completed")
                     except Exception as e:
                         logger.error(f"Error in process_scripts: {str(e)}", exc_info=True)
@@ -443,6 +828,66 @@ async def handler(websocket):
                         logger.info("Emulation processing completed")
                     except Exception as e:
                         logger.error(f"Error in process_emulation: {str(e)}", exc_info=True)
+                elif data.get('action') == 'emulate_batch':
+                    logger.info("Batch emulate action detected")
+                    base = {
+                        'from': data.get('from'),
+                        'to': data.get('to'),
+                        'data': data.get('data'),
+                        'value': data.get('value')
+                    }
+                    variants = data.get('variants') or [{}]
+                    
+                    # Каждый вариант должен получить from, to и data из base или из своих полей
+                    if not isinstance(variants, list) or len(variants) > MAX_EMULATE_VARIANTS or not all(
+                        build_variant(base, variant).get(key) for variant in variants for key in ('from', 'to', 'data')
+                    ):
+                        logger.error("Invalid variants for batch emulation")
+                        await broadcast({
+                            'type': 'error',
+                            'message': f'Each variant needs from, to and data; at most {MAX_EMULATE_VARIANTS} variants',
+                            'timestamp': datetime.now().isoformat()
+                        })
+                        continue
+                    
+                    logger.info("Starting batch emulation processing...")
+                    try:
+                        await process_emulate_batch(
+                            base, variants,
+                            block=data.get('block'),
+                            state_overrides=data.get('stateOverrides'),
+                            analyze=data.get('analyze') or []
+                        )
+                        logger.info("Batch emulation processing completed")
+                    except Exception as e:
+                        logger.error(f"Error in process_emulate_batch: {str(e)}", exc_info=True)
+                elif data.get('action') == 'scan':
+                    logger.info("Scan action detected")
+                    try:
+                        from_block = int(str(data.get('fromBlock')), 0)
+                        to_block = int(str(data.get('toBlock', data.get('fromBlock'))), 0)
+                        concurrency = max(1, int(data.get('concurrency', SCAN_CONCURRENCY)))
+                    except (TypeError, ValueError):
+                        logger.error("Invalid block range for scan")
+                        await broadcast({
+                            'type': 'error',
+                            'message': 'Invalid block range for scan',
+                            'timestamp': datetime.now().isoformat()
+                        })
+                        continue
+                    
+                    logger.info(f"Starting scan of blocks {from_block}-{to_block}...")
+                    try:
+                        await process_scan(from_block, to_block, concurrency, data.get('analyze', True))
+                        logger.info("Scan completed")
+                    except Exception as e:
+                        logger.error(f"Error in process_scan: {str(e)}", exc_info=True)
+                elif data.get('action') == 'resume':
+                    logger.info("Resume action detected")
+                    await resume(websocket, data)
+                elif data.get('action') in ('history', 'top_reverting'):
+                    # Запросы истории получает только клиент, который их отправил
+                    await websocket.send(json.dumps(await query_store(data)))
                 else:
                     logger.warning(f"Unknown action received: {data.get('action')}")
             except json.JSONDecodeError as e:
@@ -463,12 +908,39 @@ async def handler(websocket):
         connected_clients.remove(websocket)
         logger.info(f"Remaining connections: {len(connected_clients)}")
 
+async def metrics_handler(reader, writer):
+    """Отдаёт метрики в формате Prometheus по GET /metrics"""
+    try:
+        request_line = (await reader.readline()).decode(errors='replace')
+        # Пропускаем заголовки запроса
+        while (await reader.readline()).strip():
+            pass
+        if request_line.startswith('GET /metrics'):
+            status, body = '200 OK', metrics.REGISTRY.render()
+        else:
+            status, body = '404 Not Found', 'Not found\n'
+        payload = body.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
 async def main():
     """Start WebSocket server"""
     logger.info("Starting WebSocket server...")
     server = await websockets.serve(handler, '127.0.0.1', 8765)
     logger.info("WebSocket server started at ws://127.0.0.1:8765")
+    metrics_server = await asyncio.start_server(metrics_handler, '127.0.0.1', METRICS_PORT)
+    logger.info(f"Metrics endpoint started at http://127.0.0.1:{METRICS_PORT}/metrics")
     await server.wait_closed()
+    metrics_server.close()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
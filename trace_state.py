@@ -0,0 +1,274 @@
+import hashlib
+
+# Memory больше этого размера не восстанавливаем: столько газа у транзакции не бывает,
+# такие offset встречаются только у шагов, упавших с out of gas
+MAX_MEMORY_SIZE = 1 << 25
+
+CALL_OPS = ('CALL', 'CALLCODE', 'DELEGATECALL', 'STATICCALL')
+CREATE_OPS = ('CREATE', 'CREATE2')
+
+# Диапазоны memory, которые расширяет опкод: пары (позиция offset, позиция size) от верха стека
+MEMORY_ACCESS = {
+    'KECCAK256': ((0, 1),),
+    'SHA3': ((0, 1),),
+    'CALLDATACOPY': ((0, 2),),
+    'CODECOPY': ((0, 2),),
+    'RETURNDATACOPY': ((0, 2),),
+    'EXTCODECOPY': ((1, 3),),
+    'MCOPY': ((0, 2), (1, 2)),
+    'LOG0': ((0, 1),),
+    'LOG1': ((0, 1),),
+    'LOG2': ((0, 1),),
+    'LOG3': ((0, 1),),
+    'LOG4': ((0, 1),),
+    'CREATE': ((1, 2),),
+    'CREATE2': ((1, 2),),
+    'CALL': ((3, 4), (5, 6)),
+    'CALLCODE': ((3, 4), (5, 6)),
+    'DELEGATECALL': ((2, 3), (4, 5)),
+    'STATICCALL': ((2, 3), (4, 5)),
+    'RETURN': ((0, 1),),
+    'REVERT': ((0, 1),),
+}
+
+def word(stack, pos):
+    """Значение стека на позиции pos от верха"""
+    return int(stack[-1 - pos], 16)
+
+def to_address(value):
+    return "0x" + value[2:].zfill(40)
+
+def padded(data, offset, size):
+    """Срез data с дополнением нулями, как при копировании за границей данных в EVM"""
+    if size > MAX_MEMORY_SIZE:
+        return b''
+    chunk = data[offset:offset + size] if offset < len(data) else b''
+    return bytes(chunk) + bytes(size - len(chunk))
+
+class FrameMemory:
+    """
+    Memory одного фрейма, восстановленная по операциям записи.
+    Срез по словам отдаёт hex строки, как список memory в structLog geth,
+    поэтому get_memory_data работает с обоими вариантами.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data) // 32
+
+    def __getitem__(self, words):
+        start, stop, _ = words.indices(len(self))
+        return [self.data[start * 32:stop * 32].hex()]
+
+    def expand(self, offset, size):
+        """Расширяет memory до границы слова, покрывающей [offset, offset + size)"""
+        if not size:
+            return True
+        end = (offset + size + 31) // 32 * 32
+        if end > MAX_MEMORY_SIZE:
+            return False
+        if end > len(self.data):
+            self.data.extend(bytes(end - len(self.data)))
+        return True
+
+    def read(self, offset, size):
+        if not size:
+            return b''
+        return padded(self.data, offset, size)
+
+    def write(self, offset, value):
+        if self.expand(offset, len(value)):
+            self.data[offset:offset + len(value)] = value
+
+class Frame:
+    """Состояние одного вызова: memory, calldata, данные последнего вложенного вызова"""
+    __slots__ = ('memory', 'calldata', 'code', 'code_address', 'storage_address', 'returndata', 'call')
+
+    def __init__(self, calldata, code_address, storage_address, code=None, call=None):
+        self.memory = FrameMemory()
+        self.calldata = calldata
+        self.code = code
+        self.code_address = code_address
+        self.storage_address = storage_address
+        self.returndata = b''
+        # (op, ret_offset, ret_size) вызова, создавшего фрейм
+        self.call = call
+
+def precompile_output(address, data):
+    """Результат precompile, если его можно посчитать локально"""
+    if address == 2:
+        return hashlib.sha256(data).digest()
+    if address == 3:
+        try:
+            return bytes(12) + hashlib.new('ripemd160', data).digest()
+        except ValueError:
+            return None
+    if address == 4:
+        return data
+    return None
+
+class TraceState:
+    """
+    Восстанавливает memory и storage по structLog без полей memory и storage.
+    step вызывается для каждого шага трейса по порядку и возвращает memory текущего фрейма
+    до выполнения опкода этого шага.
+    """
+    def __init__(self, calldata, to, code_lookup=None):
+        to = to.lower() if to else None
+        self.frames = [Frame(bytes.fromhex((calldata or '0x')[2:]), to, to)]
+        # Последние известные значения storage: адрес -> {slot: value}
+        self.storage = {}
+        self.code_lookup = code_lookup
+        self.codes = {}
+        self.prev = None
+        # Выставляется, если часть memory восстановить не удалось (например, вывод ecrecover)
+        self.approximate = False
+
+    def step(self, log):
+        prev = self.prev
+        self.prev = log
+        if prev is not None:
+            self.apply(prev, log)
+        return self.frames[-1].memory
+
+    def apply(self, prev, log):
+        """Применяет эффекты опкода prev, зная следующий за ним шаг log"""
+        op = prev['op']
+        stack = prev.get('stack') or []
+        frame = self.frames[-1]
+        try:
+            expanded = True
+            for offset_pos, size_pos in MEMORY_ACCESS.get(op, ()):
+                expanded = frame.memory.expand(word(stack, offset_pos), word(stack, size_pos)) and expanded
+            write = WRITES.get(op)
+            if write is not None and expanded:
+                write(self, frame, stack)
+
+            depth = log.get('depth', 0)
+            prev_depth = prev.get('depth', 0)
+            if depth > prev_depth:
+                self.enter(op, stack)
+            elif depth < prev_depth:
+                self.leave(op, stack)
+            elif op in CALL_OPS or op in CREATE_OPS:
+                # Вызов без шагов внутри: EOA, precompile или неуспешный вызов
+                self.skip_call(op, stack, log)
+            elif op == 'SLOAD' and log.get('stack'):
+                self.storage.setdefault(frame.storage_address, {})[stack[-1]] = log['stack'][-1]
+        except IndexError:
+            # Шаг с переполнением стека вниз ничего не меняет
+            pass
+
+    def enter(self, op, stack):
+        parent = self.frames[-1]
+        if op in CREATE_OPS:
+            code = parent.memory.read(word(stack, 1), word(stack, 2))
+            self.frames.append(Frame(b'', None, None, code=code, call=(op, 0, 0)))
+            return
+        in_pos = 3 if op in ('CALL', 'CALLCODE') else 2
+        to = to_address(stack[-2])
+        calldata = parent.memory.read(word(stack, in_pos), word(stack, in_pos + 1))
+        # DELEGATECALL и CALLCODE исполняют чужой код в storage вызывающего контракта
+        storage_address = to if op in ('CALL', 'STATICCALL') else parent.storage_address
+        call = (op, word(stack, in_pos + 2), word(stack, in_pos + 3))
+        self.frames.append(Frame(calldata, to, storage_address, call=call))
+
+    def leave(self, op, stack):
+        if len(self.frames) == 1:
+            return
+        child = self.frames.pop()
+        parent = self.frames[-1]
+        output = b''
+        if op in ('RETURN', 'REVERT'):
+            output = child.memory.read(word(stack, 0), word(stack, 1))
+        call_op, ret_offset, ret_size = child.call
+        if call_op in CREATE_OPS:
+            # После успешного CREATE returndata пустая
+            parent.returndata = output if op == 'REVERT' else b''
+            return
+        parent.returndata = output
+        if output and ret_size:
+            parent.memory.write(ret_offset, output[:ret_size])
+
+    def skip_call(self, op, stack, log):
+        frame = self.frames[-1]
+        frame.returndata = b''
+        if op in CREATE_OPS or not log.get('stack') or not int(log['stack'][-1], 16):
+            return
+        address = int(stack[-2], 16)
+        if not 1 <= address <= 0xff:
+            return
+        in_pos = 3 if op in ('CALL', 'CALLCODE') else 2
+        output = precompile_output(address, frame.memory.read(word(stack, in_pos), word(stack, in_pos + 1)))
+        if output is None:
+            self.approximate = True
+            return
+        frame.returndata = output
+        ret_size = word(stack, in_pos + 3)
+        if ret_size:
+            frame.memory.write(word(stack, in_pos + 2), output[:ret_size])
+
+    def get_code(self, address):
+        if address not in self.codes:
+            code = self.code_lookup(address) if self.code_lookup and address else None
+            self.codes[address] = bytes.fromhex(code[2:]) if code else None
+        return self.codes[address]
+
+    def mstore(self, frame, stack):
+        frame.memory.write(word(stack, 0), word(stack, 1).to_bytes(32, 'big'))
+
+    def mstore8(self, frame, stack):
+        frame.memory.write(word(stack, 0), bytes([word(stack, 1) & 0xff]))
+
+    def mload(self, frame, stack):
+        frame.memory.expand(word(stack, 0), 32)
+
+    def calldatacopy(self, frame, stack):
+        size = word(stack, 2)
+        if size:
+            frame.memory.write(word(stack, 0), padded(frame.calldata, word(stack, 1), size))
+
+    def returndatacopy(self, frame, stack):
+        size = word(stack, 2)
+        if size:
+            frame.memory.write(word(stack, 0), padded(frame.returndata, word(stack, 1), size))
+
+    def codecopy(self, frame, stack):
+        code = frame.code if frame.code is not None else self.get_code(frame.code_address)
+        self.copy_code(frame, code, word(stack, 0), word(stack, 1), word(stack, 2))
+
+    def extcodecopy(self, frame, stack):
+        code = self.get_code(to_address(stack[-1]))
+        self.copy_code(frame, code, word(stack, 1), word(stack, 2), word(stack, 3))
+
+    def copy_code(self, frame, code, dest, offset, size):
+        if not size:
+            return
+        if code is None:
+            self.approximate = True
+            code = b''
+        frame.memory.write(dest, padded(code, offset, size))
+
+    def mcopy(self, frame, stack):
+        size = word(stack, 2)
+        if size:
+            frame.memory.write(word(stack, 0), frame.memory.read(word(stack, 1), size))
+
+    def sstore(self, frame, stack):
+        self.storage.setdefault(frame.storage_address, {})[stack[-1]] = stack[-2]
+
+# Опкоды, которые пишут в memory или storage
+WRITES = {
+    'MSTORE': TraceState.mstore,
+    'MSTORE8': TraceState.mstore8,
+    'MLOAD': TraceState.mload,
+    'CALLDATACOPY': TraceState.calldatacopy,
+    'RETURNDATACOPY': TraceState.returndatacopy,
+    'CODECOPY': TraceState.codecopy,
+    'EXTCODECOPY': TraceState.extcodecopy,
+    'MCOPY': TraceState.mcopy,
+    'SSTORE': TraceState.sstore,
+}